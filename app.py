@@ -3,12 +3,21 @@ import os
 import sys
 import json
 import io
+import math
+import random
 import re
+import tempfile
+import time
 import sqlite3
 import logging
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from html import escape
 from dotenv import load_dotenv
+import httpx
 
 from telethon import TelegramClient, events
 from telethon.extensions import html as telethon_html
@@ -16,7 +25,12 @@ from telethon.tl.types import (
     User, Chat, Channel, MessageActionTopicCreate,
     MessageMediaPhoto, MessageMediaDocument
 )
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument
+)
+from telegram import Message
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
 
 # ====== НАСТРОЙКА ЛОГИРОВАНИЯ ======
@@ -46,8 +60,54 @@ DEFAULT_TARGET_CHAT_ID = int(os.getenv('TARGET_CHAT_ID'))
 ADMIN_ID = 684460638
 
 TOPICS_DB_FILE = 'topics_mapping.json'
+TOPICS_SAVE_DELAY = 0.5  # сек, окно склейки изменений конфига в одну транзакцию
+TOPICS_SAVE_RETRY_DELAY = 5  # сек, повтор записи конфига после ошибки
 DB_FILE = 'bot_data.db'
-MAX_FILE_SIZE = 50 * 1024 * 1024
+DB_CACHE_SIZE_KB = 16 * 1024     # page cache SQLite на одно соединение
+DB_MMAP_SIZE = 256 * 1024 * 1024  # окно mmap для чтения файла базы
+DB_WRITE_BATCH = 500             # макс. пакетов изменений в одной транзакции writer-потока
+DB_READ_THREADS = 2              # потоки для чтения маппингов
+DB_MIGRATION_BATCH = 5000        # строк за шаг переноса старых msg_map / msg_map_extra
+DB_MIGRATION_PAUSE = 0.2         # сек между шагами переноса
+
+# Хранение маппингов сообщений (0 — ограничение выключено)
+MAP_RETENTION_DAYS = 30              # удалять маппинги старше N дней
+MAP_MAX_ROWS_PER_SOURCE = 200000     # хранить не больше N последних сообщений на источник
+MAP_RETENTION_INTERVAL = 3600        # сек между проходами очистки
+MAP_RETENTION_BATCH = 2000           # строк за одну транзакцию удаления
+MAP_VACUUM_PAGES = 4000              # страниц за один incremental_vacuum
+DB_CONVERT_AUTO_VACUUM = False       # True — перевести старую базу в auto_vacuum=INCREMENTAL (полный VACUUM при старте)
+MAP_CACHE_SIZE = 50000               # последних сообщений в LRU-кэше маппингов
+MIRROR_FILTER_CAPACITY = 1000000     # сообщений в одном поколении фильтра пересланных
+MIRROR_FILTER_FP_RATE = 0.01         # доля ложноположительных ответов фильтра
+MAX_FILE_SIZE = 50 * 1024 * 1024  # медиа больше лимита не скачивается, вместо него — заглушка
+MEDIA_TOO_LARGE_TEXT = "📎 <i>Файл {name} ({size_mb:.1f} МБ) больше лимита, не переслан</i>"
+MEDIA_SPOOL_MAX_MEMORY = 8 * 1024 * 1024  # файлы до N байт держатся в памяти, больше — во временном файле
+MEDIA_SPOOL_DIR = None                    # каталог временных файлов (None — системный)
+DOWNLOAD_CONCURRENCY = 8                  # одновременных потоков скачивания на весь бот
+DOWNLOAD_PARTS = 4                        # частей, качаемых параллельно для одного крупного файла
+DOWNLOAD_CHUNK_SIZE = 512 * 1024          # размер запроса upload.getFile (делитель 1 МБ)
+DOWNLOAD_PARALLEL_MIN_SIZE = 4 * 1024 * 1024  # документы меньше качаются одним потоком
+STREAM_RELAY_MIN_SIZE = 8 * 1024 * 1024   # документы от N байт заливаются по мере скачивания (0 — выкл.)
+STREAM_RELAY_TIMEOUT = 300                # сек на один запрос потоковой заливки
+DELIVERY_TIMEOUT = 600  # сек на доставку в один канал (с созданием топика, скачиванием и повторами)
+BOT_GLOBAL_RATE = 30          # запросов Bot API в секунду на весь бот
+BOT_GLOBAL_BURST = 30         # запас запросов для всплеска
+BOT_GROUP_RATE = 20 / 60      # сообщений в секунду в одну группу/канал (20 в минуту)
+BOT_GROUP_BURST = 10          # всплеск в одну группу (не меньше размера альбома)
+BOT_PRIVATE_RATE = 1          # сообщений в секунду в один личный чат
+BOT_PRIVATE_BURST = 1
+SEND_MAX_RETRIES = 5          # повторов при флуд-контроле и временных сетевых ошибках
+SEND_BACKOFF_BASE = 1.0       # сек, база экспоненциальной задержки
+SEND_BACKOFF_MAX = 60         # сек, потолок задержки
+OUTBOX_CONCURRENCY = 16       # сообщений разных линий (источник + ветка), доставляемых одновременно
+OUTBOX_POLL_INTERVAL = 5      # сек, проверка отложенных заданий
+OUTBOX_MAX_ATTEMPTS = 8       # попыток доставки в канал, затем задание удаляется
+OUTBOX_RETRY_BASE = 30        # сек, задержка перед повтором (удваивается с каждой попыткой)
+OUTBOX_RETRY_MAX = 3600       # сек, потолок задержки
+OUTBOX_SKIP_RETRYING = False  # True — отложенное после ошибки сообщение не держит свою линию
+ALBUM_LANE_TIMEOUT = 10       # сек, сколько первый элемент альбома держит линию в ожидании события Album
+FANOUT_MODE = "copy"  # "copy" — медиа в доп. каналы через copy_message из основного, "upload" — заливать заново
 
 LOG_FILE = "bot_messages.log"
 LOG_RETENTION_DAYS = 2
@@ -235,154 +295,1149 @@ def collect_recent_logs(hours=LOG_EXPORT_HOURS) -> str:
         return None
 
 # ====== DATABASE ======
-# Схема расширена: добавлена таблица msg_map_extra для хранения
-# маппингов сообщений в дополнительные каналы-назначения.
-# Основная таблица msg_map не изменилась — обратная совместимость сохранена.
+# Маппинги сообщений привязаны к чату-источнику: id сообщений Telegram уникальны
+# только внутри чата.
+#   msg_link       — (src_chat_id, src_id) -> сообщение в основном канале
+#   msg_link_extra — (src_chat_id, src_id, tgt_chat_id) -> сообщение в доп. канале
+# Обе таблицы WITHOUT ROWID: строки лежат прямо в B-дереве первичного ключа,
+# поэтому поиск по (src_chat_id, src_id) — один seek без обращения к отдельной таблице.
+# Старые msg_map / msg_map_extra (ключ только src_id) переносятся в фоне пачками
+# с src_chat_id = LEGACY_SRC_CHAT_ID: чат у них неизвестен, поиск использует их
+# как запасной вариант.
+# ts — время записи маппинга; фоновая очистка удаляет строки старше
+# MAP_RETENTION_DAYS и сверх MAP_MAX_ROWS_PER_SOURCE на источник, после чего
+# освобождённые страницы возвращаются через incremental_vacuum.
+# Все копии сообщения отдаёт resolve_all одним запросом: {tgt_chat_id: маппинг}.
+# Перед таблицами стоит LRU последних MAP_CACHE_SIZE сообщений: save/save_extra
+# пишут в него сразу (write-through), поэтому ответы и правки свежих сообщений
+# разрешаются без SQLite — даже до того, как writer-поток закоммитит строку.
+# Новые сообщения заводятся в LRU при постановке в outbox (DB.cache_new).
+# Если сообщения в LRU нет (вытеснено, перезапуск), неизвестно, какие ещё копии
+# лежат в базе: новые маппинги копятся отдельно (_lru_pending) и накладываются
+# на ближайшее чтение из базы.
+# Правки чужих (не пересланных) сообщений отсекает MirrorFilter ещё до поиска.
+# Соединения долгоживущие, по одному на поток (цикл событий, потоки executor'а):
+# WAL + synchronous=NORMAL, кэш подготовленных выражений и увеличенный page cache.
+# Цикл событий с SQLite напрямую не работает: записи уходят в очередь отдельного
+# writer-потока, который коммитит их группами (много INSERT в одной транзакции),
+# а чтения выполняются в своём пуле потоков через await.
+
+LEGACY_SRC_CHAT_ID = 0
+
+class MirrorFilter:
+    """
+    Вращающийся фильтр Блума по парам (src_chat_id, src_id) пересланных сообщений.
+    Два поколения по capacity элементов: когда текущее заполнено, предыдущее
+    выбрасывается. Ложноотрицательных ответов в пределах двух поколений нет,
+    ложноположительные (~fp_rate) отсекает обычный поиск маппинга.
+    add защищён блокировкой: при старте фильтр заполняется из потока чтения,
+    пока event loop добавляет новые отправки.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = None
+        self.count = 0
+        self.ready = False       # до загрузки из базы фильтр пропускает всё
+        self.has_legacy = False  # есть перенесённые строки без чата (src_chat_id = 0)
+        self._lock = threading.Lock()
+
+    def _positions(self, src_chat_id, src_id):
+        # Двойное хеширование: k позиций из двух независимых хешей
+        h1 = hash((src_chat_id, src_id))
+        h2 = hash((src_id, src_chat_id, 0x9E3779B9)) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    @staticmethod
+    def _test(bits, positions) -> bool:
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add(self, src_chat_id, src_id):
+        if src_chat_id == LEGACY_SRC_CHAT_ID:
+            self.has_legacy = True
+        positions = self._positions(src_chat_id, src_id)
+        with self._lock:
+            if self._test(self.current, positions):
+                return
+            if self.count >= self.capacity:
+                self.previous, self.current = self.current, bytearray(len(self.current))
+                self.count = 0
+            for p in positions:
+                self.current[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def _contains(self, src_chat_id, src_id) -> bool:
+        positions = self._positions(src_chat_id, src_id)
+        return self._test(self.current, positions) or (
+            self.previous is not None and self._test(self.previous, positions)
+        )
+
+    def might_contain(self, src_chat_id, src_id) -> bool:
+        if not self.ready:
+            return True
+        if self._contains(src_chat_id, src_id):
+            return True
+        return self.has_legacy and self._contains(LEGACY_SRC_CHAT_ID, src_id)
 
 class DB:
+    _local = threading.local()
+    _legacy_pending = False
+    _lru = OrderedDict()  # (src_chat_id, src_id) -> результат resolve_all
+    _lru_pending = OrderedDict()  # (src_chat_id, src_id) -> маппинги, записанные мимо LRU
+    _source_rows = None  # src_chat_id -> примерное число строк msg_link (None — ещё не подсчитано)
+    _incremental_vacuum_ok = False
+    _mirrored = MirrorFilter(MIRROR_FILTER_CAPACITY, MIRROR_FILTER_FP_RATE)
+    _write_queue = queue.Queue()
+    _writer = None
+    _read_executor = None
+
+    @staticmethod
+    def connection() -> sqlite3.Connection:
+        """Возвращает постоянное соединение текущего потока, открывая его при первом вызове."""
+        conn = getattr(DB._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(DB_FILE, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA busy_timeout=5000')
+            conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+            conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+            DB._local.conn = conn
+        return conn
+
+    @staticmethod
+    def close():
+        """Закрывает соединение текущего потока (при остановке бота)."""
+        conn = getattr(DB._local, "conn", None)
+        if conn is None:
+            return
+        try:
+            conn.execute('PRAGMA optimize')
+        except sqlite3.Error:
+            pass
+        conn.close()
+        DB._local.conn = None
+
     @staticmethod
     def init():
-        with sqlite3.connect(DB_FILE) as conn:
+        conn = DB.connection()
+        # incremental_vacuum работает только при auto_vacuum=INCREMENTAL. Новая база
+        # создаётся сразу в этом режиме; существующую переводит только полный VACUUM
+        # (долго и x2 места на диске) — он выполняется лишь по DB_CONVERT_AUTO_VACUUM.
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            fresh = conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0
+            if fresh or DB_CONVERT_AUTO_VACUUM:
+                if not fresh:
+                    logger.info("[DB] Перевожу базу в auto_vacuum=INCREMENTAL (полный VACUUM)...")
+                # Пустая база в WAL уже инициализирована — режим применяет VACUUM (мгновенный)
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+            else:
+                logger.warning(
+                    "[DB] auto_vacuum != INCREMENTAL: освобождённые очисткой страницы переиспользуются, "
+                    "но файл не уменьшается (DB_CONVERT_AUTO_VACUUM = True — перевести базу)"
+                )
+        DB._incremental_vacuum_ok = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+        with conn:
             conn.execute(
-                'CREATE TABLE IF NOT EXISTS msg_map '
-                '(src_id INTEGER PRIMARY KEY, tgt_id INTEGER, tid INTEGER, custom_target_id INTEGER)'
+                'CREATE TABLE IF NOT EXISTS msg_link '
+                '(src_chat_id INTEGER NOT NULL, src_id INTEGER NOT NULL, '
+                'tgt_chat_id INTEGER, tgt_id INTEGER, tid INTEGER, ts INTEGER, as_text INTEGER, '
+                'PRIMARY KEY (src_chat_id, src_id)) WITHOUT ROWID'
             )
-            # Новая таблица: маппинг src_id -> (tgt_chat_id, tgt_id, tid) для каждого доп. канала.
-            # Одному src_id может соответствовать несколько строк (по одной на доп. канал).
+            # Одному сообщению источника соответствует по строке на каждый доп. канал.
             conn.execute(
-                'CREATE TABLE IF NOT EXISTS msg_map_extra '
-                '(src_id INTEGER, tgt_chat_id INTEGER, tgt_id INTEGER, tid INTEGER, '
-                'PRIMARY KEY (src_id, tgt_chat_id))'
+                'CREATE TABLE IF NOT EXISTS msg_link_extra '
+                '(src_chat_id INTEGER NOT NULL, src_id INTEGER NOT NULL, '
+                'tgt_chat_id INTEGER NOT NULL, tgt_id INTEGER, tid INTEGER, ts INTEGER, as_text INTEGER, '
+                'PRIMARY KEY (src_chat_id, src_id, tgt_chat_id)) WITHOUT ROWID'
             )
+            # Таблицы, созданные до появления ts: у старых строк ts = NULL,
+            # по возрасту они не удаляются (только по лимиту на источник).
+            # as_text = 1 — копия отправлена текстом (заглушка вместо медиа),
+            # NULL — неизвестно (старые строки), правка выбирается по исходному сообщению.
+            for table in ('msg_link', 'msg_link_extra'):
+                columns = {r[1] for r in conn.execute(f'PRAGMA table_info({table})')}
+                if 'ts' not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN ts INTEGER')
+                if 'as_text' not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN as_text INTEGER')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_ts ON {table} (ts)')
+            # Telethon photo/document id -> file_id Bot API (повторная отправка без заливки)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS media_file_ids '
+                '(media_key TEXT PRIMARY KEY, file_id TEXT NOT NULL, ts INTEGER) WITHOUT ROWID'
+            )
+            # Задания доставки: по строке на (сообщение источника, канал назначения)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS outbox '
+                '(src_chat_id INTEGER NOT NULL, src_id INTEGER NOT NULL, tgt_chat_id INTEGER NOT NULL, '
+                'is_extra INTEGER NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt_at REAL NOT NULL, created_at REAL NOT NULL, lane TEXT NOT NULL DEFAULT \'\', '
+                'PRIMARY KEY (src_chat_id, src_id, tgt_chat_id)) WITHOUT ROWID'
+            )
+            # Задания, записанные до появления линий: lane = '', каждое сообщение — своя линия
+            if 'lane' not in {r[1] for r in conn.execute('PRAGMA table_info(outbox)')}:
+                conn.execute("ALTER TABLE outbox ADD COLUMN lane TEXT NOT NULL DEFAULT ''")
+            # Готовность заданий диспетчер держит в памяти (Outbox._queues)
+            conn.execute('DROP INDEX IF EXISTS outbox_due')
+        DB._legacy_pending = bool(DB._legacy_tables())
 
     @staticmethod
-    def save(src_id, tgt_chat_id, tgt_id, tid):
-        """Сохраняет маппинг для основного канала."""
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.execute(
-                'INSERT OR REPLACE INTO msg_map (src_id, tgt_id, tid, custom_target_id) VALUES (?, ?, ?, ?)',
-                (src_id, tgt_id, tid, tgt_chat_id)
+    def _legacy_tables() -> set:
+        return {
+            r[0] for r in DB.connection().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name IN ('msg_map', 'msg_map_extra')"
             )
+        }
 
     @staticmethod
-    def save_extra(src_id, tgt_chat_id, tgt_id, tid):
-        """Сохраняет маппинг для дополнительного канала."""
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.execute(
-                'INSERT OR REPLACE INTO msg_map_extra (src_id, tgt_chat_id, tgt_id, tid) VALUES (?, ?, ?, ?)',
-                (src_id, tgt_chat_id, tgt_id, tid)
+    def _legacy_left(table: str) -> bool:
+        return DB.connection().execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is not None
+
+    @staticmethod
+    async def migrate_legacy():
+        """
+        Онлайн-перенос msg_map / msg_map_extra в новые таблицы.
+        Каждый шаг — одна транзакция writer-потока (INSERT пачки + DELETE её же),
+        поэтому строка всегда находится ровно в одной из таблиц и поиск её видит.
+        """
+        if not DB._legacy_pending:
+            return
+        steps = {
+            'msg_map': (
+                'INSERT OR IGNORE INTO msg_link (src_chat_id, src_id, tgt_chat_id, tgt_id, tid, ts) '
+                f'SELECT {LEGACY_SRC_CHAT_ID}, src_id, custom_target_id, tgt_id, tid, '
+                "CAST(strftime('%s', 'now') AS INTEGER) FROM msg_map "
+                'WHERE src_id IN (SELECT src_id FROM msg_map ORDER BY src_id LIMIT ?)',
+                'DELETE FROM msg_map WHERE src_id IN (SELECT src_id FROM msg_map ORDER BY src_id LIMIT ?)',
+            ),
+            'msg_map_extra': (
+                'INSERT OR IGNORE INTO msg_link_extra (src_chat_id, src_id, tgt_chat_id, tgt_id, tid, ts) '
+                f'SELECT {LEGACY_SRC_CHAT_ID}, src_id, tgt_chat_id, tgt_id, tid, '
+                "CAST(strftime('%s', 'now') AS INTEGER) FROM msg_map_extra "
+                'WHERE rowid IN (SELECT rowid FROM msg_map_extra ORDER BY rowid LIMIT ?)',
+                'DELETE FROM msg_map_extra WHERE rowid IN '
+                '(SELECT rowid FROM msg_map_extra ORDER BY rowid LIMIT ?)',
+            ),
+        }
+        try:
+            for table in await DB._read(DB._legacy_tables):
+                copy_sql, delete_sql = steps[table]
+                moved = 0
+                while await DB._read(DB._legacy_left, table):
+                    await DB.commit([
+                        (copy_sql, (DB_MIGRATION_BATCH,)),
+                        (delete_sql, (DB_MIGRATION_BATCH,)),
+                    ])
+                    moved += DB_MIGRATION_BATCH
+                    await asyncio.sleep(DB_MIGRATION_PAUSE)
+                await DB.commit([(f'DROP TABLE {table}', ())])
+                logger.info(f"[DB MIGRATION] {table} перенесена (~{moved} строк) и удалена")
+            DB._legacy_pending = False
+        except Exception as e:
+            logger.error(f"[DB MIGRATION ERROR] {e}")
+
+    # ------------------------------------------------------------------ #
+    # Очистка старых маппингов
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _count_sources() -> dict:
+        return dict(DB.connection().execute('SELECT src_chat_id, COUNT(*) FROM msg_link GROUP BY src_chat_id'))
+
+    @staticmethod
+    def _count_source(src_chat_id) -> int:
+        return DB.connection().execute(
+            'SELECT COUNT(*) FROM msg_link WHERE src_chat_id = ?', (src_chat_id,)
+        ).fetchone()[0]
+
+    @staticmethod
+    def _source_cutoff(src_chat_id) -> int | None:
+        """src_id, начиная с которого (включительно) строки источника выходят за лимит."""
+        r = DB.connection().execute(
+            'SELECT src_id FROM msg_link WHERE src_chat_id = ? ORDER BY src_id DESC LIMIT 1 OFFSET ?',
+            (src_chat_id, MAP_MAX_ROWS_PER_SOURCE)
+        ).fetchone()
+        return r[0] if r else None
+
+    @staticmethod
+    async def _delete_batches(sql: str, params: tuple) -> int:
+        """
+        Повторяет пакетный DELETE (LIMIT = MAP_RETENTION_BATCH), пока он удаляет полные пачки.
+        Каждая пачка — своя короткая транзакция writer-потока, обычные записи идут между ними.
+        """
+        total = 0
+        while True:
+            deleted = await DB.commit([(sql, params)])
+            total += deleted
+            if deleted < MAP_RETENTION_BATCH:
+                return total
+            await asyncio.sleep(0)
+
+    @staticmethod
+    def _incremental_vacuum():
+        if not DB._incremental_vacuum_ok:
+            return
+        # sqlite3.execute делает один шаг PRAGMA (= одна страница), до конца её
+        # доводит только executescript. Это короткая запись из соединения пула;
+        # с writer-потоком она разводится блокировкой SQLite (busy_timeout).
+        DB.connection().executescript(f'PRAGMA incremental_vacuum({MAP_VACUUM_PAGES});')
+
+    @staticmethod
+    async def enforce_retention():
+        """Один проход очистки: по возрасту, по лимиту на источник, затем incremental_vacuum."""
+        deleted = 0
+        if MAP_RETENTION_DAYS > 0:
+            cutoff_ts = int(time.time()) - MAP_RETENTION_DAYS * 86400
+            deleted += await DB._delete_batches(
+                'DELETE FROM msg_link WHERE (src_chat_id, src_id) IN '
+                '(SELECT src_chat_id, src_id FROM msg_link WHERE ts < ? LIMIT ?)',
+                (cutoff_ts, MAP_RETENTION_BATCH)
+            )
+            deleted += await DB._delete_batches(
+                'DELETE FROM msg_link_extra WHERE (src_chat_id, src_id, tgt_chat_id) IN '
+                '(SELECT src_chat_id, src_id, tgt_chat_id FROM msg_link_extra WHERE ts < ? LIMIT ?)',
+                (cutoff_ts, MAP_RETENTION_BATCH)
             )
 
+        if MAP_MAX_ROWS_PER_SOURCE > 0:
+            # Счётчики строк на источник: полный подсчёт — один раз, дальше их
+            # ведёт link_ops. Поиск границы (OFFSET) — только для источников сверх лимита.
+            if DB._source_rows is None:
+                DB._source_rows = await DB._read(DB._count_sources)
+            for src_chat_id, rows in list(DB._source_rows.items()):
+                if rows <= MAP_MAX_ROWS_PER_SOURCE:
+                    continue
+                cutoff_id = await DB._read(DB._source_cutoff, src_chat_id)
+                if cutoff_id is None:
+                    # Счётчик завышен (REPLACE, очистка по возрасту) — пересчитываем
+                    DB._source_rows[src_chat_id] = await DB._read(DB._count_source, src_chat_id)
+                    continue
+                removed = await DB._delete_batches(
+                    'DELETE FROM msg_link WHERE src_chat_id = ? AND src_id IN '
+                    '(SELECT src_id FROM msg_link WHERE src_chat_id = ? AND src_id <= ? LIMIT ?)',
+                    (src_chat_id, src_chat_id, cutoff_id, MAP_RETENTION_BATCH)
+                )
+                DB._source_rows[src_chat_id] = DB._source_rows.get(src_chat_id, 0) - removed
+                deleted += removed
+                deleted += await DB._delete_batches(
+                    'DELETE FROM msg_link_extra WHERE (src_chat_id, src_id, tgt_chat_id) IN '
+                    '(SELECT src_chat_id, src_id, tgt_chat_id FROM msg_link_extra '
+                    'WHERE src_chat_id = ? AND src_id <= ? LIMIT ?)',
+                    (src_chat_id, cutoff_id, MAP_RETENTION_BATCH)
+                )
+
+        if deleted:
+            await DB._read(DB._incremental_vacuum)
+            logger.info(f"[DB RETENTION] Удалено маппингов: {deleted}")
+
     @staticmethod
-    def get(src_id):
-        """Возвращает маппинг основного канала."""
-        with sqlite3.connect(DB_FILE) as conn:
-            r = conn.execute(
-                'SELECT tgt_id, tid, custom_target_id FROM msg_map WHERE src_id = ?',
-                (src_id,)
-            ).fetchone()
-            if r:
-                return {"tgt_id": r[0], "tid": r[1], "tgt_chat_id": r[2]}
-            return None
+    async def retention_loop():
+        """Фоновая задача: периодически применяет политику хранения маппингов."""
+        while True:
+            try:
+                await DB.enforce_retention()
+            except Exception as e:
+                logger.error(f"[DB RETENTION ERROR] {e}")
+            await asyncio.sleep(MAP_RETENTION_INTERVAL)
+
+    # ------------------------------------------------------------------ #
+    # Writer-поток
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def start():
+        """Запускает writer-поток и пул чтения."""
+        if DB._writer is not None:
+            return
+        DB._read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+        DB._writer = threading.Thread(target=DB._writer_loop, name="db-writer", daemon=True)
+        DB._writer.start()
+
+    @staticmethod
+    def stop():
+        """Дожидается записи всей очереди и останавливает потоки."""
+        if DB._writer is not None:
+            DB._write_queue.put(None)
+            DB._writer.join()
+            DB._writer = None
+        if DB._read_executor is not None:
+            DB._read_executor.shutdown(wait=True)
+            DB._read_executor = None
+
+    @staticmethod
+    def _execute(conn, ops) -> int:
+        return sum(max(conn.execute(sql, params).rowcount, 0) for sql, params in ops)
 
     @staticmethod
-    def get_extra(src_id):
+    def _apply(conn, ops) -> int:
+        with conn:
+            return DB._execute(conn, ops)
+
+    @staticmethod
+    def _writer_loop():
+        conn = DB.connection()
+        running = True
+        while running:
+            item = DB._write_queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= DB_WRITE_BATCH:
+                    break
+                try:
+                    item = DB._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            if not batch:
+                continue
+
+            try:
+                with conn:
+                    results = [(on_done, None, DB._execute(conn, ops)) for ops, on_done in batch]
+            except Exception as e:
+                # Общая транзакция откатилась — пишем пакеты по одному,
+                # чтобы один битый не потерял остальные.
+                logger.error(f"[DB WRITE ERROR] group commit ({len(batch)}): {e}")
+                results = []
+                for ops, on_done in batch:
+                    try:
+                        results.append((on_done, None, DB._apply(conn, ops)))
+                    except Exception as single_err:
+                        logger.error(f"[DB WRITE ERROR] {single_err}")
+                        results.append((on_done, single_err, 0))
+
+            for on_done, err, rowcount in results:
+                if on_done is not None:
+                    try:
+                        on_done(err, rowcount)
+                    except Exception as cb_err:
+                        logger.error(f"[DB WRITE CALLBACK ERROR] {cb_err}")
+        DB.close()
+
+    @staticmethod
+    def submit(ops: list, on_done=None):
         """
-        Возвращает список маппингов для всех дополнительных каналов.
-        Формат: [{"tgt_chat_id": ..., "tgt_id": ..., "tid": ...}, ...]
+        Ставит пакет изменений [(sql, params), ...] в очередь writer-потока.
+        Пакет применяется атомарно; on_done(err, rowcount) вызывается из writer-потока.
+        Если writer не запущен (инициализация), пишет сразу в текущем потоке.
         """
-        with sqlite3.connect(DB_FILE) as conn:
-            rows = conn.execute(
-                'SELECT tgt_chat_id, tgt_id, tid FROM msg_map_extra WHERE src_id = ?',
-                (src_id,)
-            ).fetchall()
-            return [{"tgt_chat_id": r[0], "tgt_id": r[1], "tid": r[2]} for r in rows]
+        if DB._writer is None:
+            err, rowcount = None, 0
+            try:
+                rowcount = DB._apply(DB.connection(), ops)
+            except Exception as e:
+                logger.error(f"[DB WRITE ERROR] {e}")
+                err = e
+            if on_done is not None:
+                on_done(err, rowcount)
+            return
+        DB._write_queue.put((ops, on_done))
+
+    @staticmethod
+    async def commit(ops: list) -> int:
+        """Ставит пакет изменений в очередь, ждёт его фиксации и возвращает число изменённых строк."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def resolve(err, rowcount):
+            if fut.done():
+                return
+            if err is None:
+                fut.set_result(rowcount)
+            else:
+                fut.set_exception(err)
+
+        DB.submit(ops, lambda err, rowcount: loop.call_soon_threadsafe(resolve, err, rowcount))
+        return await fut
+
+    @staticmethod
+    async def _read(fn, *args):
+        if DB._read_executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(DB._read_executor, fn, *args)
+
+    # ------------------------------------------------------------------ #
+    # Маппинги сообщений
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _cache_entry(src_chat_id, src_id) -> dict | None:
+        key = (src_chat_id, src_id)
+        entry = DB._lru.get(key)
+        if entry is not None:
+            DB._lru.move_to_end(key)
+        return entry
+
+    @staticmethod
+    def _cache_put(src_chat_id, src_id, entry: dict) -> dict:
+        DB._lru[(src_chat_id, src_id)] = entry
+        if len(DB._lru) > MAP_CACHE_SIZE:
+            DB._lru.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def cache_new(src_chat_id, src_ids: list):
+        """
+        Заводит в LRU пустые записи для новых сообщений источника: копий у них ещё
+        нет, поэтому кэш — полная картина их маппингов с первой же отправки.
+        """
+        for src_id in src_ids:
+            if DB._cache_entry(src_chat_id, src_id) is None:
+                DB._cache_put(src_chat_id, src_id, DB._lru_pending.pop((src_chat_id, src_id), None) or {})
+
+    @staticmethod
+    def _cache_for_write(src_chat_id, src_id) -> dict:
+        DB._mirrored.add(src_chat_id, src_id)
+        entry = DB._cache_entry(src_chat_id, src_id)
+        if entry is None:
+            # Часть копий может быть только в базе — запись кэша не создаём
+            key = (src_chat_id, src_id)
+            entry = DB._lru_pending.get(key)
+            if entry is None:
+                entry = DB._lru_pending[key] = {}
+                if len(DB._lru_pending) > MAP_CACHE_SIZE:
+                    DB._lru_pending.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def link_ops(src_chat_id, links: list, tgt_chat_id, tid, extra: bool = False, as_text: bool = False) -> list:
+        """
+        Обновляет кэш и возвращает SQL-операции маппингов нескольких сообщений
+        в один канал. links — [(src_id, tgt_id), ...], например члены альбома.
+        as_text=True — копии отправлены текстовыми сообщениями (send_message).
+        """
+        table = 'msg_link_extra' if extra else 'msg_link'
+        ts = int(time.time())
+        if not extra and DB._source_rows is not None:
+            DB._source_rows[src_chat_id] = DB._source_rows.get(src_chat_id, 0) + len(links)
+        ops = []
+        for src_id, tgt_id in links:
+            entry = DB._cache_for_write(src_chat_id, src_id)
+            # Если канал указан и основным, и доп. — побеждает основной
+            if not (extra and tgt_chat_id in entry and not entry[tgt_chat_id]["extra"]):
+                entry[tgt_chat_id] = {
+                    "tgt_chat_id": tgt_chat_id, "tgt_id": tgt_id, "tid": tid, "extra": extra,
+                    "as_text": as_text
+                }
+            ops.append((
+                f'INSERT OR REPLACE INTO {table} (src_chat_id, src_id, tgt_chat_id, tgt_id, tid, ts, as_text) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (src_chat_id, src_id, tgt_chat_id, tgt_id, tid, ts, int(as_text))
+            ))
+        return ops
+
+    @staticmethod
+    def save_many(src_chat_id, links: list, tgt_chat_id, tid, extra: bool = False):
+        """Сохраняет маппинги нескольких сообщений одной транзакцией (не ждёт записи)."""
+        DB.submit(DB.link_ops(src_chat_id, links, tgt_chat_id, tid, extra))
+
+    @staticmethod
+    def save(src_chat_id, src_id, tgt_chat_id, tgt_id, tid):
+        """Сохраняет маппинг для основного канала (не ждёт записи)."""
+        DB.save_many(src_chat_id, [(src_id, tgt_id)], tgt_chat_id, tid)
+
+    @staticmethod
+    def save_extra(src_chat_id, src_id, tgt_chat_id, tgt_id, tid):
+        """Сохраняет маппинг для дополнительного канала (не ждёт записи)."""
+        DB.save_many(src_chat_id, [(src_id, tgt_id)], tgt_chat_id, tid, extra=True)
+
+    @staticmethod
+    def maybe_mirrored(src_chat_id, src_id) -> bool:
+        """Быстрая проверка в памяти: False — сообщение точно не пересылалось."""
+        return DB._mirrored.might_contain(src_chat_id, src_id)
+
+    @staticmethod
+    def _fill_mirror_filter():
+        conn = DB.connection()
+        flt = DB._mirrored
+        # Самые свежие сообщения, в пределах одного поколения фильтра
+        for table in ('msg_link', 'msg_link_extra'):
+            for src_chat_id, src_id in conn.execute(
+                f'SELECT src_chat_id, src_id FROM {table} ORDER BY ts DESC LIMIT ?',
+                (MIRROR_FILTER_CAPACITY,)
+            ):
+                flt.add(src_chat_id, src_id)
+        if DB._legacy_pending:
+            flt.has_legacy = True
+
+    @staticmethod
+    async def load_mirror_filter():
+        """Заполняет фильтр пересланных сообщений из базы (при старте)."""
+        try:
+            await DB._read(DB._fill_mirror_filter)
+            DB._mirrored.ready = True
+            logger.info(f"[DB] Фильтр пересланных сообщений загружен: {DB._mirrored.count}")
+        except Exception as e:
+            logger.error(f"[DB FILTER ERROR] {e}")
+
+    @staticmethod
+    def _resolve_sync(src_chat_id, src_id) -> dict:
+        conn = DB.connection()
+        rows = conn.execute(
+            'SELECT 0, tgt_chat_id, tgt_id, tid, as_text, src_chat_id = ?1 FROM msg_link '
+            'WHERE src_chat_id IN (?1, ?2) AND src_id = ?3 '
+            'UNION ALL '
+            'SELECT 1, tgt_chat_id, tgt_id, tid, as_text, src_chat_id = ?1 FROM msg_link_extra '
+            'WHERE src_chat_id IN (?1, ?2) AND src_id = ?3',
+            (src_chat_id, LEGACY_SRC_CHAT_ID, src_id)
+        ).fetchall()
+        # Перенесённые строки без чата (src_chat_id = 0) — только если точных нет
+        exact = [r for r in rows if r[5]]
+        rows = [r[:5] for r in (exact or rows)]
+        if not rows and DB._legacy_pending:
+            try:
+                rows = conn.execute(
+                    'SELECT 0, custom_target_id, tgt_id, tid, NULL FROM msg_map WHERE src_id = ?1 '
+                    'UNION ALL '
+                    'SELECT 1, tgt_chat_id, tgt_id, tid, NULL FROM msg_map_extra WHERE src_id = ?1',
+                    (src_id,)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                rows = []  # таблицы уже перенесены и удалены
+
+        main, extras = None, {}
+        for is_extra, tgt_chat_id, tgt_id, tid, as_text in rows:
+            mapping = {
+                "tgt_chat_id": tgt_chat_id, "tgt_id": tgt_id, "tid": tid, "extra": bool(is_extra),
+                "as_text": None if as_text is None else bool(as_text)
+            }
+            if is_extra:
+                extras[tgt_chat_id] = mapping
+            else:
+                main = mapping
+        # Основной канал первым; если он же указан доп. каналом — побеждает основной
+        resolved = {main["tgt_chat_id"]: main} if main else {}
+        for tgt_chat_id, mapping in extras.items():
+            resolved.setdefault(tgt_chat_id, mapping)
+        return resolved
+
+    @staticmethod
+    async def resolve_all(src_chat_id, src_id) -> dict:
+        """
+        Возвращает все копии сообщения источника одним запросом:
+        {tgt_chat_id: {"tgt_chat_id", "tgt_id", "tid", "extra": bool, "as_text": bool | None}}.
+        Основной канал (extra=False) идёт первым. Пустой dict — сообщение не пересылалось.
+        """
+        entry = DB._cache_entry(src_chat_id, src_id)
+        if entry is not None:
+            return entry
+        loaded = await DB._read(DB._resolve_sync, src_chat_id, src_id)
+        # Пока шло чтение, save мог уже положить в кэш более свежие данные
+        entry = DB._cache_entry(src_chat_id, src_id)
+        if entry is not None:
+            return entry
+        # Маппинги, записанные без кэша, могли ещё не дойти до базы
+        pending = DB._lru_pending.pop((src_chat_id, src_id), None)
+        if pending:
+            for tgt_chat_id, mapping in pending.items():
+                current = loaded.get(tgt_chat_id)
+                if not (mapping["extra"] and current is not None and not current["extra"]):
+                    loaded[tgt_chat_id] = mapping
+            loaded = dict(sorted(loaded.items(), key=lambda item: item[1]["extra"]))
+        return DB._cache_put(src_chat_id, src_id, loaded)
+
+    # ------------------------------------------------------------------ #
+    # Кэш file_id медиа
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _get_file_id_sync(media_key: str) -> str | None:
+        row = DB.connection().execute(
+            'SELECT file_id FROM media_file_ids WHERE media_key = ?', (media_key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    async def get_file_id(media_key: str) -> str | None:
+        return await DB._read(DB._get_file_id_sync, media_key)
+
+    @staticmethod
+    def save_file_id(media_key: str, file_id: str):
+        DB.submit([(
+            'INSERT OR REPLACE INTO media_file_ids (media_key, file_id, ts) VALUES (?, ?, ?)',
+            (media_key, file_id, int(time.time()))
+        )])
+
+    @staticmethod
+    def drop_file_id(media_key: str, file_id: str):
+        """Удаляет устаревший file_id (только если его ещё не заменили новым)."""
+        DB.submit([(
+            'DELETE FROM media_file_ids WHERE media_key = ? AND file_id = ?',
+            (media_key, file_id)
+        )])
 
 # ====== TOPIC MANAGER ======
-# Новое поле в JSON-конфиге чата: "extra_targets" — список доп. каналов.
-# Каждый элемент: {"chat_id": int, "topics": {"<source_tid>": <target_tid>}}
-# Топики для доп. каналов управляются независимо от основного.
+
+def normalize_chat_id(chat_id) -> str:
+    """
+    Каноническая форма ID источника — «голый» положительный id, как его отдаёт
+    Telethon в chat.id. Маркированные формы Bot API (-100XXXXXXXXXX для каналов
+    и супергрупп, -XXXX для обычных групп) сводятся к ней по правилам Telethon.
+    """
+    s = str(chat_id).strip()
+    try:
+        value = int(s)
+    except ValueError:
+        return s
+    if value >= 0:
+        return str(value)
+    value = -value
+    if value > 1000000000000:
+        value -= 1000000000000
+    return str(value)
+
+# Конфиг источников хранится в bot_data.db в четырёх таблицах:
+#   topic_sources       — источник (chat_id) и его настройки
+#   topic_source_topics — ветки источника: (chat_id, s_tid) -> topic_id в основном канале
+#   topic_extra_targets — доп. каналы источника: (chat_id, extra_chat_id)
+#   topic_extra_topics  — ветки доп. каналов: (chat_id, extra_chat_id, s_tid) -> topic_id
+# В памяти держится та же структура, что раньше лежала в topics_mapping.json
+# (её читает интерфейс управления), плюс индекс доп. каналов по (chat_id, extra_chat_id)
+# и скомпилированные маршруты по (chat_id, s_tid) — см. get_route.
+# Все методы принимают id источника в любой форме (123, -100123, "-123"):
+# индекс алиасов сразу отдаёт ключ, под которым источник лежит в конфиге.
+# Каждое изменение — точечный UPSERT/DELETE одной строки; все изменения за
+# TOPICS_SAVE_DELAY сек пишутся одной транзакцией вне цикла событий.
+# topics_mapping.json импортируется при первом запуске, выгрузка — /exporttopics.
 
 class TopicManager:
+    _cache = None
+    _extra_index = {}
+    _aliases = {}
+    _routes = {}
+    _pending = []
+    _flush_task = None
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS topic_sources '
+        '(chat_id TEXT PRIMARY KEY, title TEXT, type TEXT, enabled INTEGER NOT NULL DEFAULT 1, '
+        'custom_target_id INTEGER, auto_create_topics INTEGER NOT NULL DEFAULT 1)',
+        'CREATE TABLE IF NOT EXISTS topic_source_topics '
+        '(chat_id TEXT NOT NULL, s_tid TEXT NOT NULL, topic_id INTEGER, title TEXT, '
+        'enabled INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (chat_id, s_tid))',
+        'CREATE TABLE IF NOT EXISTS topic_extra_targets '
+        '(chat_id TEXT NOT NULL, extra_chat_id INTEGER NOT NULL, PRIMARY KEY (chat_id, extra_chat_id))',
+        'CREATE TABLE IF NOT EXISTS topic_extra_topics '
+        '(chat_id TEXT NOT NULL, extra_chat_id INTEGER NOT NULL, s_tid TEXT NOT NULL, topic_id INTEGER, '
+        'PRIMARY KEY (chat_id, extra_chat_id, s_tid)) WITHOUT ROWID',
+    )
+
+    _UPSERT_SOURCE = (
+        'INSERT INTO topic_sources (chat_id, title, type, enabled, custom_target_id, auto_create_topics) '
+        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(chat_id) DO UPDATE SET '
+        'title = excluded.title, type = excluded.type, enabled = excluded.enabled, '
+        'custom_target_id = excluded.custom_target_id, auto_create_topics = excluded.auto_create_topics'
+    )
+    _UPSERT_TOPIC = (
+        'INSERT INTO topic_source_topics (chat_id, s_tid, topic_id, title, enabled) '
+        'VALUES (?, ?, ?, ?, ?) ON CONFLICT(chat_id, s_tid) DO UPDATE SET '
+        'topic_id = excluded.topic_id, title = excluded.title, enabled = excluded.enabled'
+    )
+    _UPSERT_EXTRA_TOPIC = (
+        'INSERT INTO topic_extra_topics (chat_id, extra_chat_id, s_tid, topic_id) '
+        'VALUES (?, ?, ?, ?) ON CONFLICT(chat_id, extra_chat_id, s_tid) DO UPDATE SET '
+        'topic_id = excluded.topic_id'
+    )
+
+    # ------------------------------------------------------------------ #
+    # Загрузка, импорт / экспорт
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def init():
+        """Создаёт таблицы, при пустой базе импортирует topics_mapping.json и грузит кэш."""
+        with DB.connection() as conn:
+            for sql in TopicManager._SCHEMA:
+                conn.execute(sql)
+            empty = conn.execute('SELECT 1 FROM topic_sources LIMIT 1').fetchone() is None
+        if empty and os.path.exists(TOPICS_DB_FILE):
+            TopicManager.import_json(TOPICS_DB_FILE)
+        TopicManager._load()
+
+    @staticmethod
+    def _load():
+        db = {}
+        with DB.connection() as conn:
+            for chat_id, title, chat_type, enabled, custom_target, auto_create in conn.execute(
+                'SELECT chat_id, title, type, enabled, custom_target_id, auto_create_topics '
+                'FROM topic_sources ORDER BY rowid'
+            ):
+                db[chat_id] = {
+                    "title": title,
+                    "type": chat_type,
+                    "enabled": bool(enabled),
+                    "custom_target_id": custom_target,
+                    "auto_create_topics": bool(auto_create),
+                    "extra_targets": [],
+                    "topics": {}
+                }
+            for chat_id, s_tid, topic_id, title, enabled in conn.execute(
+                'SELECT chat_id, s_tid, topic_id, title, enabled FROM topic_source_topics ORDER BY rowid'
+            ):
+                if chat_id in db:
+                    db[chat_id]["topics"][s_tid] = {
+                        "topic_id": topic_id, "title": title, "enabled": bool(enabled)
+                    }
+            for chat_id, extra_chat_id in conn.execute(
+                'SELECT chat_id, extra_chat_id FROM topic_extra_targets ORDER BY rowid'
+            ):
+                if chat_id in db:
+                    db[chat_id]["extra_targets"].append({"chat_id": extra_chat_id, "topics": {}})
+            extra_topics = conn.execute(
+                'SELECT chat_id, extra_chat_id, s_tid, topic_id FROM topic_extra_topics'
+            ).fetchall()
+
+        TopicManager._cache = db
+        TopicManager._routes = {}
+        TopicManager._reindex()
+        for chat_id, extra_chat_id, s_tid, topic_id in extra_topics:
+            et = TopicManager._extra_index.get((chat_id, extra_chat_id))
+            if et is not None:
+                et["topics"][s_tid] = topic_id
+        logger.info(f"[TOPICS] Загружено источников: {len(db)}")
+
+    @staticmethod
+    def _add_aliases(c_key: str):
+        canonical = normalize_chat_id(c_key)
+        aliases = TopicManager._aliases
+        for alias in (c_key, canonical, f"-{canonical}", f"-100{canonical}"):
+            # канонический ключ важнее устаревших форм, если в конфиге есть оба
+            if alias not in aliases or c_key == canonical:
+                aliases[alias] = c_key
+
+    @staticmethod
+    def resolve_key(chat_id) -> str:
+        """
+        Ключ источника в конфиге для id в любой форме.
+        Для неизвестного источника — каноническая форма (под ней он будет зарегистрирован).
+        """
+        if TopicManager._cache is None:
+            TopicManager._load()
+        c_key = TopicManager._aliases.get(str(chat_id))
+        if c_key is not None:
+            return c_key
+        canonical = normalize_chat_id(chat_id)
+        return TopicManager._aliases.get(canonical, canonical)
+
+    @staticmethod
+    def _reindex():
+        TopicManager._aliases = {}
+        for c_key in TopicManager._cache:
+            TopicManager._add_aliases(c_key)
+        TopicManager._extra_index = {
+            (c_key, et["chat_id"]): et
+            for c_key, cdata in TopicManager._cache.items()
+            for et in cdata.get("extra_targets", [])
+        }
+
+    @staticmethod
+    def import_json(path: str):
+        """Импортирует конфиг в старом формате topics_mapping.json (строки перезаписываются)."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        with DB.connection() as conn:
+            for c_key, cdata in data.items():
+                conn.execute(TopicManager._UPSERT_SOURCE, (
+                    str(c_key), cdata.get("title"), cdata.get("type"),
+                    int(cdata.get("enabled", True)), cdata.get("custom_target_id"),
+                    int(cdata.get("auto_create_topics", True))
+                ))
+                for t_key, tdata in cdata.get("topics", {}).items():
+                    conn.execute(TopicManager._UPSERT_TOPIC, (
+                        str(c_key), str(t_key), tdata.get("topic_id"),
+                        tdata.get("title"), int(tdata.get("enabled", True))
+                    ))
+                for et in cdata.get("extra_targets", []):
+                    conn.execute(
+                        'INSERT OR IGNORE INTO topic_extra_targets (chat_id, extra_chat_id) VALUES (?, ?)',
+                        (str(c_key), et["chat_id"])
+                    )
+                    for s_tid, t_tid in et.get("topics", {}).items():
+                        conn.execute(TopicManager._UPSERT_EXTRA_TOPIC, (
+                            str(c_key), et["chat_id"], str(s_tid), t_tid
+                        ))
+        logger.info(f"[TOPICS] Импортировано источников из {path}: {len(data)}")
+        if TopicManager._cache is not None:
+            TopicManager._load()
+
+    @staticmethod
+    def export_json(path: str):
+        """Выгружает текущий конфиг в формате topics_mapping.json (атомарно)."""
+        payload = json.dumps(TopicManager.load_db(), indent=2, ensure_ascii=False)
+        dir_name = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".topics_", suffix=".tmp", dir=dir_name)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
     @staticmethod
     def load_db():
-        if not os.path.exists(TOPICS_DB_FILE):
-            return {}
+        """
+        Возвращает закэшированный конфиг (структура topics_mapping.json).
+        Только для чтения: изменения делаются методами TopicManager.
+        """
+        if TopicManager._cache is None:
+            TopicManager._load()
+        return TopicManager._cache
+
+    # ------------------------------------------------------------------ #
+    # Отложенная запись изменений
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _queue(sql: str, params: tuple):
+        """
+        Ставит точечное изменение в очередь на запись.
+        Вне цикла событий (нет running loop) пишет сразу.
+        """
+        # Первый параметр любого изменения — chat_id источника:
+        # его маршруты перекомпилируются при следующем обращении.
+        TopicManager._routes.pop(params[0], None)
+        TopicManager._pending.append((sql, params))
         try:
-            with open(TOPICS_DB_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            TopicManager.flush()
+            return
+        if TopicManager._flush_task is None:
+            TopicManager._flush_task = loop.create_task(TopicManager._flush_later())
 
     @staticmethod
-    def save_db(db):
-        with open(TOPICS_DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(db, f, indent=2, ensure_ascii=False)
+    def _queue_source(c_key: str):
+        cdata = TopicManager._cache[c_key]
+        TopicManager._queue(TopicManager._UPSERT_SOURCE, (
+            c_key, cdata.get("title"), cdata.get("type"), int(cdata.get("enabled", True)),
+            cdata.get("custom_target_id"), int(cdata.get("auto_create_topics", True))
+        ))
 
     @staticmethod
-    def get_status(chat_id, s_tid=0):
-        db = TopicManager.load_db()
-        chat_data = db.get(str(chat_id))
+    def _queue_topic(c_key: str, t_key: str):
+        tdata = TopicManager._cache[c_key]["topics"][t_key]
+        TopicManager._queue(TopicManager._UPSERT_TOPIC, (
+            c_key, t_key, tdata.get("topic_id"), tdata.get("title"), int(tdata.get("enabled", True))
+        ))
 
-        logger.info(f"[GET_STATUS] chat_id={chat_id}, s_tid={s_tid}")
+    @staticmethod
+    async def _flush_later():
+        try:
+            await asyncio.sleep(TOPICS_SAVE_DELAY)
+            while TopicManager._pending:
+                ops, TopicManager._pending = TopicManager._pending, []
+                try:
+                    await DB.commit(ops)
+                except Exception as e:
+                    TopicManager._pending = ops + TopicManager._pending
+                    logger.error(f"[TOPICS SAVE ERROR] {e} — повтор через {TOPICS_SAVE_RETRY_DELAY} сек")
+                    await asyncio.sleep(TOPICS_SAVE_RETRY_DELAY)
+        finally:
+            TopicManager._flush_task = None
 
-        if not chat_data:
-            logger.info("[GET_STATUS] -> new (chat not found)")
-            return "new"
+    @staticmethod
+    def flush():
+        """Отдаёт несохранённые изменения writer-потоку (при остановке бота — до DB.stop)."""
+        if TopicManager._flush_task is not None:
+            TopicManager._flush_task.cancel()
+            TopicManager._flush_task = None
+        if not TopicManager._pending:
+            return
+        ops, TopicManager._pending = TopicManager._pending, []
+        DB.submit(ops)
 
-        if not chat_data.get('enabled', True):
-            logger.info("[GET_STATUS] -> paused (chat disabled)")
-            return "paused"
+    # ------------------------------------------------------------------ #
+    # Чтение
+    # ------------------------------------------------------------------ #
 
-        t_key = str(s_tid or 0)
-        topic_data = chat_data.get('topics', {}).get(t_key)
+    @staticmethod
+    def get_source(chat_id) -> dict | None:
+        return TopicManager.load_db().get(TopicManager.resolve_key(chat_id))
 
-        logger.info(f"[GET_STATUS] t_key={t_key}, topic_data={topic_data}")
+    @staticmethod
+    def get_route(chat_id, s_tid=0) -> dict:
+        """
+        Возвращает скомпилированный маршрут для (источник, ветка источника):
+          status             — new / paused / active / active_need_topic
+          target_chat        — основной канал назначения
+          target_tid         — топик в основном канале (как в конфиге, может быть None)
+          auto_create_topics — можно ли создавать новые топики
+          extras             — [(extra_chat_id, extra_tid | None), ...]
+        Маршруты источника сбрасываются при любом его изменении и
+        собираются заново при первом обращении.
+        """
+        c_key, s_tid = TopicManager.resolve_key(chat_id), int(s_tid or 0)
+        chat_routes = TopicManager._routes.get(c_key)
+        if chat_routes is None:
+            chat_routes = TopicManager._routes[c_key] = {}
+        route = chat_routes.get(s_tid)
+        if route is None:
+            route = chat_routes[s_tid] = TopicManager._compile_route(c_key, s_tid)
+        return route
 
-        if topic_data and not topic_data.get('enabled', True):
-            logger.info("[GET_STATUS] -> paused (topic disabled)")
-            return "paused"
+    @staticmethod
+    def _compile_route(c_key: str, s_tid: int) -> dict:
+        chat_data = TopicManager.get_source(c_key)
+        if not chat_data:
+            return {
+                "status": "new",
+                "target_chat": DEFAULT_TARGET_CHAT_ID,
+                "target_tid": None,
+                "auto_create_topics": True,
+                "extras": [],
+            }
 
-        result = "active" if (topic_data and topic_data.get('topic_id')) else "active_need_topic"
-        logger.info(f"[GET_STATUS] -> {result}")
-        return result
+        t_key = str(s_tid)
+        topic_data = chat_data.get('topics', {}).get(t_key)
+        if not chat_data.get('enabled', True):
+            status = "paused"
+        elif topic_data and not topic_data.get('enabled', True):
+            status = "paused"
+        elif topic_data and topic_data.get('topic_id'):
+            status = "active"
+        else:
+            status = "active_need_topic"
+
+        extras = []
+        for et in chat_data.get("extra_targets", []):
+            extra_tid = et["topics"].get(t_key)
+            if extra_tid is not None and int(extra_tid) <= 1:
+                extra_tid = None
+            extras.append((et["chat_id"], extra_tid))
+
+        return {
+            "status": status,
+            "target_chat": chat_data.get('custom_target_id') or DEFAULT_TARGET_CHAT_ID,
+            "target_tid": (topic_data or {}).get('topic_id'),
+            "auto_create_topics": chat_data.get("auto_create_topics", True),
+            "extras": extras,
+        }
 
     @staticmethod
-    def register_source(chat_id, title, chat_type, s_tid=0, s_tname=None, target_tid=None):
-        db = TopicManager.load_db()
-        c_key, t_key = str(chat_id), str(s_tid or 0)
+    def get_status(chat_id, s_tid=0):
+        return TopicManager.get_route(chat_id, s_tid)["status"]
 
+    # ------------------------------------------------------------------ #
+    # Изменение источников и веток
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _ensure_source(c_key: str, title, chat_type, enabled=None) -> dict:
+        db = TopicManager.load_db()
         if c_key not in db:
-            default_enabled = False if chat_type == "private" else True
+            if enabled is None:
+                enabled = chat_type != "private"
             db[c_key] = {
                 "title": title,
                 "type": chat_type,
-                "enabled": default_enabled,
+                "enabled": enabled,
                 "custom_target_id": None,
                 "auto_create_topics": True,
                 "extra_targets": [],   # <- список доп. каналов
                 "topics": {}
             }
+            TopicManager._add_aliases(c_key)
+            TopicManager._queue_source(c_key)
+        return db[c_key]
 
-        if "auto_create_topics" not in db[c_key]:
-            db[c_key]["auto_create_topics"] = True
-
-        # Миграция: добавляем поле если его нет в старых записях
-        if "extra_targets" not in db[c_key]:
-            db[c_key]["extra_targets"] = []
+    @staticmethod
+    def register_source(chat_id, title, chat_type, s_tid=0, s_tname=None, target_tid=None):
+        c_key, t_key = TopicManager.resolve_key(chat_id), str(s_tid or 0)
+        cdata = TopicManager._ensure_source(c_key, title, chat_type)
 
-        existing_topic = db[c_key]["topics"].get(t_key, {})
-        db[c_key]["topics"][t_key] = {
+        existing_topic = cdata["topics"].get(t_key, {})
+        cdata["topics"][t_key] = {
             "topic_id": target_tid or existing_topic.get('topic_id'),
             "title": s_tname or existing_topic.get('title') or (
                 "Личка" if chat_type == "private" else (f"Thread {t_key}" if t_key != "0" else "Main")
             ),
             "enabled": existing_topic.get('enabled', True)
         }
-        TopicManager.save_db(db)
+        TopicManager._queue_topic(c_key, t_key)
+
+    @staticmethod
+    def bind_topic(chat_id, s_tid, target_tid):
+        """Ручная привязка ветки источника к топику основного канала (/bindtopic)."""
+        c_key, t_key = TopicManager.resolve_key(chat_id), str(s_tid)
+        cdata = TopicManager._ensure_source(c_key, f"ManualBind {chat_id}", "channel", enabled=True)
+        existing_topic = cdata["topics"].get(t_key, {})
+        cdata["topics"][t_key] = {
+            "topic_id": target_tid,
+            "title": existing_topic.get("title") or f"Thread {s_tid}",
+            "enabled": existing_topic.get("enabled", True)
+        }
+        TopicManager._queue_topic(c_key, t_key)
+
+    @staticmethod
+    def _update_source(chat_id, field: str, value) -> bool:
+        c_key = TopicManager.resolve_key(chat_id)
+        cdata = TopicManager.load_db().get(c_key)
+        if not cdata:
+            return False
+        cdata[field] = value
+        TopicManager._queue_source(c_key)
+        return True
+
+    @staticmethod
+    def set_enabled(chat_id, enabled: bool) -> bool:
+        return TopicManager._update_source(chat_id, "enabled", enabled)
+
+    @staticmethod
+    def set_auto_create_topics(chat_id, value: bool) -> bool:
+        return TopicManager._update_source(chat_id, "auto_create_topics", value)
+
+    @staticmethod
+    def set_custom_target(chat_id, target_id: int | None) -> bool:
+        return TopicManager._update_source(chat_id, "custom_target_id", target_id)
+
+    @staticmethod
+    def _update_topic(chat_id, s_tid, field: str, value) -> bool:
+        c_key, t_key = TopicManager.resolve_key(chat_id), str(s_tid)
+        tdata = TopicManager.load_db().get(c_key, {}).get("topics", {}).get(t_key)
+        if tdata is None:
+            return False
+        tdata[field] = value
+        TopicManager._queue_topic(c_key, t_key)
+        return True
+
+    @staticmethod
+    def set_topic_id(chat_id, s_tid, topic_id: int | None) -> bool:
+        return TopicManager._update_topic(chat_id, s_tid, "topic_id", topic_id)
+
+    @staticmethod
+    def set_topic_enabled(chat_id, s_tid, enabled: bool) -> bool:
+        return TopicManager._update_topic(chat_id, s_tid, "enabled", enabled)
+
+    @staticmethod
+    def delete_topic(chat_id, s_tid) -> bool:
+        c_key, t_key = TopicManager.resolve_key(chat_id), str(s_tid)
+        topics = TopicManager.load_db().get(c_key, {}).get("topics", {})
+        if t_key not in topics:
+            return False
+        del topics[t_key]
+        TopicManager._queue(
+            'DELETE FROM topic_source_topics WHERE chat_id = ? AND s_tid = ?', (c_key, t_key)
+        )
+        return True
 
     # ------------------------------------------------------------------ #
-    # Новые методы для управления дополнительными каналами
+    # Методы для управления дополнительными каналами
     # ------------------------------------------------------------------ #
 
     @staticmethod
@@ -391,67 +1446,219 @@ class TopicManager:
         Возвращает список доп. каналов для источника.
         Формат: [{"chat_id": int, "topics": {"<s_tid>": <t_tid>}}, ...]
         """
-        db = TopicManager.load_db()
-        return db.get(str(chat_id), {}).get("extra_targets", [])
+        return (TopicManager.get_source(chat_id) or {}).get("extra_targets", [])
 
     @staticmethod
     def add_extra_target(chat_id: str, extra_chat_id: int) -> bool:
         """Добавляет доп. канал к источнику. Возвращает False если уже есть."""
-        db = TopicManager.load_db()
-        c_key = str(chat_id)
-        if c_key not in db:
+        c_key = TopicManager.resolve_key(chat_id)
+        cdata = TopicManager.load_db().get(c_key)
+        if not cdata:
             return False
-        if "extra_targets" not in db[c_key]:
-            db[c_key]["extra_targets"] = []
+        if (c_key, extra_chat_id) in TopicManager._extra_index:
+            return False
+
+        et = {"chat_id": extra_chat_id, "topics": {}}
+        cdata.setdefault("extra_targets", []).append(et)
+        TopicManager._extra_index[(c_key, extra_chat_id)] = et
+        TopicManager._queue(
+            'INSERT OR IGNORE INTO topic_extra_targets (chat_id, extra_chat_id) VALUES (?, ?)',
+            (c_key, extra_chat_id)
+        )
+        return True
+
+    @staticmethod
+    def remove_extra_target(chat_id: str, extra_chat_id: int):
+        """Удаляет доп. канал из источника."""
+        c_key = TopicManager.resolve_key(chat_id)
+        cdata = TopicManager.load_db().get(c_key)
+        if not cdata:
+            return
+        cdata["extra_targets"] = [
+            et for et in cdata.get("extra_targets", [])
+            if et["chat_id"] != extra_chat_id
+        ]
+        TopicManager._extra_index.pop((c_key, extra_chat_id), None)
+        TopicManager._queue(
+            'DELETE FROM topic_extra_targets WHERE chat_id = ? AND extra_chat_id = ?',
+            (c_key, extra_chat_id)
+        )
+        TopicManager._queue(
+            'DELETE FROM topic_extra_topics WHERE chat_id = ? AND extra_chat_id = ?',
+            (c_key, extra_chat_id)
+        )
+
+    @staticmethod
+    def set_extra_topic(chat_id: str, extra_chat_id: int, s_tid: str, t_tid: int):
+        """Сохраняет маппинг топика для конкретного доп. канала."""
+        c_key = TopicManager.resolve_key(chat_id)
+        et = TopicManager._extra_index.get((c_key, extra_chat_id))
+        if et is None:
+            return
+        et["topics"][str(s_tid)] = t_tid
+        TopicManager._queue(TopicManager._UPSERT_EXTRA_TOPIC, (c_key, extra_chat_id, str(s_tid), t_tid))
+
+    @staticmethod
+    def get_extra_topic(chat_id: str, extra_chat_id: int, s_tid) -> int | None:
+        """Возвращает target_tid для конкретного доп. канала и source topic."""
+        et = TopicManager._extra_index.get((TopicManager.resolve_key(chat_id), extra_chat_id))
+        if et is None:
+            return None
+        return et["topics"].get(str(s_tid))
+
+# ====== RATE LIMITER ======
+# Лимиты Bot API: ~20 сообщений в минуту в одну группу и ~30 в секунду на бота.
+# Каждый вызов сначала берёт токен из корзины своего чата, затем из общей;
+# если токенов нет — ждёт в очереди (asyncio.Lock отпускает ждущих по порядку),
+# а не получает 429 от Telegram.
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class RateLimiter:
+    _global = TokenBucket(BOT_GLOBAL_RATE, BOT_GLOBAL_BURST)
+    _chats = {}
+
+    @staticmethod
+    def _bucket(chat_id) -> TokenBucket:
+        bucket = RateLimiter._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы, положительные — личные чаты
+            if int(chat_id) < 0:
+                bucket = TokenBucket(BOT_GROUP_RATE, BOT_GROUP_BURST)
+            else:
+                bucket = TokenBucket(BOT_PRIVATE_RATE, BOT_PRIVATE_BURST)
+            RateLimiter._chats[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    async def acquire(chat_id, cost: int = 1):
+        await RateLimiter._bucket(chat_id).acquire(cost)
+        await RateLimiter._global.acquire(cost)
+
+    @staticmethod
+    def pause(chat_id, delay: float):
+        """Telegram вернул RetryAfter — чат молчит delay сек для всех отправителей."""
+        bucket = RateLimiter._bucket(chat_id)
+        # Следующий токен появится ровно через delay сек
+        bucket.tokens = min(bucket.tokens, 1 - delay * bucket.rate)
+        bucket.updated = time.monotonic()
+
+    @staticmethod
+    async def call(chat_id, method, /, *args, cost: int = 1, **kwargs):
+        """Вызов метода Bot API в чат chat_id с учётом лимитов (cost — число сообщений)."""
+        await RateLimiter.acquire(chat_id, cost)
+        return await method(*args, **kwargs)
+
+# ====== ОШИБКИ BOT API ======
+# Исключения PTB сводятся к категориям, у каждой своя политика:
+#   retry_after — флуд-контроль: чат ставится на паузу на время из ответа, повтор
+#   transient   — TimedOut / NetworkError / сбой соединения: повтор с exp. backoff + jitter
+#   topic       — ветка удалена: пересоздать топик
+#   reply       — сообщение для reply не найдено: отправить без reply
+#   file        — устаревший file_id: удалить из кэша и залить заново
+#   fatal       — остальное (нет прав, бот удалён, неверный запрос): без повторов
+# Счётчики по категориям — в /stats.
+
+class SendErrors:
+    _counters = {}
 
-        # Проверяем дубликат
-        for et in db[c_key]["extra_targets"]:
-            if et["chat_id"] == extra_chat_id:
-                return False
+    @staticmethod
+    def classify(e: Exception) -> str:
+        if isinstance(e, RetryAfter):
+            return "retry_after"
+        if isinstance(e, BadRequest):
+            text = e.message.lower()
+            if "thread" in text:
+                return "topic"
+            if "reply" in text or "replied" in text:
+                return "reply"
+            if "file" in text:
+                return "file"
+            return "fatal"
+        if isinstance(e, (Forbidden, ChatMigrated)):
+            return "fatal"
+        if isinstance(e, (TimedOut, NetworkError, httpx.TransportError, OSError, asyncio.TimeoutError)):
+            return "transient"
+        return "fatal"
 
-        db[c_key]["extra_targets"].append({"chat_id": extra_chat_id, "topics": {}})
-        TopicManager.save_db(db)
-        return True
+    @staticmethod
+    def record(e: Exception) -> str:
+        category = SendErrors.classify(e)
+        SendErrors._counters[category] = SendErrors._counters.get(category, 0) + 1
+        return category
 
     @staticmethod
-    def remove_extra_target(chat_id: str, extra_chat_id: int):
-        """Удаляет доп. канал из источника."""
-        db = TopicManager.load_db()
-        c_key = str(chat_id)
-        if c_key not in db:
-            return
-        db[c_key]["extra_targets"] = [
-            et for et in db[c_key].get("extra_targets", [])
-            if et["chat_id"] != extra_chat_id
-        ]
-        TopicManager.save_db(db)
+    def stats() -> dict:
+        return dict(SendErrors._counters)
 
     @staticmethod
-    def set_extra_topic(chat_id: str, extra_chat_id: int, s_tid: str, t_tid: int):
-        """Сохраняет маппинг топика для конкретного доп. канала."""
-        db = TopicManager.load_db()
-        c_key = str(chat_id)
-        for et in db.get(c_key, {}).get("extra_targets", []):
-            if et["chat_id"] == extra_chat_id:
-                et["topics"][str(s_tid)] = t_tid
-                TopicManager.save_db(db)
-                return
+    async def wait_before_retry(chat_id, e: Exception, category: str, retries: int) -> bool:
+        """
+        Ожидание перед повтором для retry_after / transient.
+        False — повторять не нужно (другая категория или исчерпаны повторы).
+        """
+        if retries >= SEND_MAX_RETRIES:
+            return False
+        if category == "retry_after":
+            delay = e.retry_after
+            delay = delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+            logger.warning(f"[FLOOD] Чат {chat_id}: Telegram просит подождать {delay:.0f} сек")
+            # Ожидание — в RateLimiter, вместе с остальными отправками в этот чат
+            RateLimiter.pause(chat_id, delay)
+            return True
+        if category == "transient":
+            delay = random.uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * 2 ** retries))
+            logger.warning(f"[RETRY] Чат {chat_id}: {e}. Повтор через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+            return True
+        return False
 
     @staticmethod
-    def get_extra_topic(chat_id: str, extra_chat_id: int, s_tid) -> int | None:
-        """Возвращает target_tid для конкретного доп. канала и source topic."""
-        for et in TopicManager.get_extra_targets(chat_id):
-            if et["chat_id"] == extra_chat_id:
-                return et["topics"].get(str(s_tid))
-        return None
+    async def retrying(chat_id, call):
+        """call() с повторами для retry_after / transient; прочие ошибки пробрасываются."""
+        retries = 0
+        while True:
+            try:
+                return await call()
+            except Exception as e:
+                category = SendErrors.record(e)
+                if not await SendErrors.wait_before_retry(chat_id, e, category, retries):
+                    raise
+                retries += 1
 
 # ====== FORUM MANAGER ======
+# Топики создаются single-flight: пока для (target_chat, источник, ветка) идёт
+# create_forum_topic, остальные сообщения этой ветки ждут тот же результат,
+# а не создают дубликаты.
+
 class ForumManager:
+    _inflight = {}
+
     @staticmethod
     async def create_topic(target_chat, chat_title, s_tname=None):
         try:
             name = (f"{s_tname} | {chat_title}" if s_tname else f"💬 {chat_title}")[:120]
-            res = await bot_app.bot.create_forum_topic(chat_id=target_chat, name=name)
+            res = await SendErrors.retrying(target_chat, lambda: RateLimiter.call(
+                target_chat, bot_app.bot.create_forum_topic, chat_id=target_chat, name=name
+            ))
             tid = res.message_thread_id
             logger.info(f"[FORUM] Создан новый топик '{name}' ID: {tid} в чате {target_chat}")
             return tid
@@ -459,6 +1666,76 @@ class ForumManager:
             logger.error(f"[FORUM ERROR] Ошибка создания топика: {e}")
             return None
 
+    @staticmethod
+    def _configured_topic(target_chat, chat_id_str, source_top_id, is_extra):
+        if is_extra:
+            tid = TopicManager.get_extra_topic(chat_id_str, target_chat, source_top_id)
+        else:
+            tid = TopicManager.get_route(chat_id_str, source_top_id)["target_tid"]
+        return tid if tid and int(tid) > 1 else None
+
+    @staticmethod
+    def invalidate_topic(target_chat, chat_id_str, source_top_id, stale_tid, is_extra=False) -> int | None:
+        """
+        Сбрасывает невалидный топик ветки (compare-and-clear): конфиг очищается,
+        только если в нём всё ещё stale_tid. Если топик уже пересоздан другим
+        сообщением — возвращает его, иначе None.
+        """
+        configured = ForumManager._configured_topic(target_chat, chat_id_str, source_top_id, is_extra)
+        if configured and int(configured) != int(stale_tid):
+            return configured
+        if is_extra:
+            TopicManager.set_extra_topic(chat_id_str, target_chat, str(source_top_id), None)
+        else:
+            TopicManager.set_topic_id(chat_id_str, source_top_id, None)
+        return None
+
+    @staticmethod
+    async def provision_topic(
+        target_chat, chat_id_str, source_top_id, chat_title, chat_type,
+        s_tname=None, is_extra=False
+    ):
+        """
+        Возвращает топик для ветки источника в target_chat, создавая его при необходимости.
+        Новый топик сразу записывается в конфиг (основной канал или доп. канал).
+        """
+        key = (target_chat, chat_id_str, int(source_top_id or 0))
+        task = ForumManager._inflight.get(key)
+        if task is None:
+            # Топик мог появиться, пока сообщение шло сюда
+            existing = ForumManager._configured_topic(target_chat, chat_id_str, source_top_id, is_extra)
+            if existing:
+                return existing
+
+            task = asyncio.ensure_future(ForumManager._create_and_register(
+                target_chat, chat_id_str, source_top_id, chat_title, chat_type, s_tname, is_extra
+            ))
+            ForumManager._inflight[key] = task
+
+            def _done(t, key=key):
+                if ForumManager._inflight.get(key) is t:
+                    del ForumManager._inflight[key]
+            task.add_done_callback(_done)
+        else:
+            logger.info(f"[FORUM] Жду уже идущее создание топика {key}")
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _create_and_register(
+        target_chat, chat_id_str, source_top_id, chat_title, chat_type, s_tname, is_extra
+    ):
+        new_tid = await ForumManager.create_topic(target_chat, chat_title, s_tname=s_tname)
+        if not new_tid:
+            return None
+        if is_extra:
+            TopicManager.set_extra_topic(chat_id_str, target_chat, str(source_top_id), new_tid)
+        else:
+            TopicManager.register_source(
+                int(chat_id_str), chat_title, chat_type,
+                source_top_id, s_tname=s_tname, target_tid=new_tid
+            )
+        return new_tid
+
 def resolve_source_topic_id(msg, chat=None, chat_conf=None) -> int:
     if getattr(msg, 'message_thread_id', None):
         return int(msg.message_thread_id)
@@ -480,20 +1757,22 @@ def resolve_source_topic_id(msg, chat=None, chat_conf=None) -> int:
 
     return 0
 
+def message_lane(chat_id, msg) -> str:
+    """
+    Линия доставки: источник + ветка. Считается только по самому сообщению
+    (без запросов), чтобы все сообщения одной ветки всегда попадали в одну линию.
+    """
+    reply_to = getattr(msg, 'reply_to', None)
+    topic = getattr(msg, 'message_thread_id', None) or getattr(reply_to, 'reply_to_top_id', None)
+    if not topic and getattr(reply_to, 'forum_topic', False):
+        topic = getattr(reply_to, 'reply_to_msg_id', None)
+    return f"{normalize_chat_id(chat_id)}:{int(topic or 0)}"
+
 # ====== ИНТЕРФЕЙС УПРАВЛЕНИЯ ======
 
 async def show_manage_menu(query, cid, db):
-    cdata = db.get(str(cid))
-    if not cdata:
-        alt_cid = str(cid).replace("-100", "")
-        cdata = db.get(alt_cid)
-        if cdata:
-            cid = alt_cid
-    if not cdata:
-        alt_cid = f"-100{cid}" if not str(cid).startswith("-100") else cid
-        cdata = db.get(alt_cid)
-        if cdata:
-            cid = alt_cid
+    cid = TopicManager.resolve_key(cid)
+    cdata = db.get(cid)
     if not cdata:
         logger.warning(f"ID {cid} не найден в базе при попытке открыть меню")
         return
@@ -614,6 +1893,31 @@ async def cmd_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
+async def cmd_exporttopics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    try:
+        TopicManager.export_json(TOPICS_DB_FILE)
+        with open(TOPICS_DB_FILE, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=os.path.basename(TOPICS_DB_FILE),
+                caption="🗂 Конфиг источников и веток"
+            )
+    except Exception as e:
+        logger.error(f"[CMD /exporttopics ERROR] {e}")
+        await update.message.reply_text(f"❌ Ошибка выгрузки конфига: {e}")
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    stats = SendErrors.stats()
+    lines = [f"• `{category}`: {count}" for category, count in sorted(stats.items())]
+    await update.message.reply_text(
+        "📊 *Ошибки Bot API с запуска:*\n" + ("\n".join(lines) if lines else "нет"),
+        parse_mode='Markdown'
+    )
+
 async def cmd_bindtopic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
@@ -639,32 +1943,7 @@ async def cmd_bindtopic(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ target_topic_id должен быть больше 0.")
         return
     try:
-        db = TopicManager.load_db()
-        c_key = str(source_chat_id)
-        t_key = str(source_topic_id)
-        if c_key not in db:
-            db[c_key] = {
-                "title": f"ManualBind {source_chat_id}",
-                "type": "channel",
-                "enabled": True,
-                "custom_target_id": None,
-                "auto_create_topics": True,
-                "extra_targets": [],
-                "topics": {}
-            }
-        if "topics" not in db[c_key]:
-            db[c_key]["topics"] = {}
-        if "auto_create_topics" not in db[c_key]:
-            db[c_key]["auto_create_topics"] = True
-        if "extra_targets" not in db[c_key]:
-            db[c_key]["extra_targets"] = []
-        existing_topic = db[c_key]["topics"].get(t_key, {})
-        db[c_key]["topics"][t_key] = {
-            "topic_id": target_topic_id,
-            "title": existing_topic.get("title") or f"Thread {source_topic_id}",
-            "enabled": existing_topic.get("enabled", True)
-        }
-        TopicManager.save_db(db)
+        TopicManager.bind_topic(source_chat_id, source_topic_id, target_topic_id)
         logger.info(
             f"[MANUAL BIND] source_chat_id={source_chat_id}, "
             f"source_topic_id={source_topic_id}, target_topic_id={target_topic_id}"
@@ -712,16 +1991,15 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("tgc_"):
         cid = data.split("_", 1)[1]
-        db[cid]['enabled'] = not db[cid]['enabled']
-        TopicManager.save_db(db)
+        if cid in db:
+            TopicManager.set_enabled(cid, not db[cid]['enabled'])
         await show_manage_menu(query, cid, db)
 
     elif data.startswith("tat_"):
         cid = data.split("_", 1)[1]
         if cid in db:
             current = db[cid].get("auto_create_topics", True)
-            db[cid]["auto_create_topics"] = not current
-            TopicManager.save_db(db)
+            TopicManager.set_auto_create_topics(cid, not current)
         await show_manage_menu(query, cid, db)
 
     elif data.startswith("editchat_"):
@@ -746,7 +2024,6 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cid = parts[1]
         extra_chat_id = int(parts[2])
         TopicManager.remove_extra_target(cid, extra_chat_id)
-        db = TopicManager.load_db()  # перечитываем после изменения
         await show_manage_menu(query, cid, db)
 
     elif data.startswith("editid_"):
@@ -758,17 +2035,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("del_"):
         _, cid, tid = data.split("_", 2)
-        if cid in db and tid in db[cid].get('topics', {}):
-            del db[cid]['topics'][tid]
-            TopicManager.save_db(db)
+        if TopicManager.delete_topic(cid, tid):
             await show_manage_menu(query, cid, db)
 
     elif data.startswith("tgt_"):
         _, cid, tid = data.split("_", 2)
         if cid in db and tid in db[cid].get('topics', {}):
             current = db[cid]['topics'][tid].get('enabled', True)
-            db[cid]['topics'][tid]['enabled'] = not current
-            TopicManager.save_db(db)
+            TopicManager.set_topic_enabled(cid, tid, not current)
         await show_manage_menu(query, cid, db)
 
     elif data == "main_menu":
@@ -781,16 +2055,15 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     state = user_edit_state.pop(user_id)
     new_input = update.message.text.strip()
-    db = TopicManager.load_db()
     cid = state["cid"]
 
     if state["mode"] == "target_chat":
         if new_input == "0":
-            db[cid]['custom_target_id'] = None
+            TopicManager.set_custom_target(cid, None)
             text = "✅ Теперь используются настройки по умолчанию."
         else:
             try:
-                db[cid]['custom_target_id'] = int(new_input)
+                TopicManager.set_custom_target(cid, int(new_input))
                 text = f"✅ Основной канал назначения изменён на `{new_input}`"
             except:
                 await update.message.reply_text("❌ Ошибка: Введите корректный ID (число).")
@@ -814,15 +2087,322 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state["mode"] == "topic_id":
         tid = state["tid"]
         if new_input.isdigit():
-            db[cid]['topics'][tid]['topic_id'] = int(new_input)
+            TopicManager.set_topic_id(cid, tid, int(new_input))
             text = f"✅ Новый Target ID для ветки `{tid}` установлен: `{new_input}`"
         else:
             await update.message.reply_text("❌ Ошибка: Введите число.")
             return
 
-    TopicManager.save_db(db)
     await update.message.reply_text(text + "\nИспользуйте /list для управления.")
 
+# ====== DOWNLOADER ======
+# Крупные документы качаются несколькими частями параллельно через iter_download
+# (для чужих DC Telethon переиспользует закэшированные exported senders).
+# Общий семафор ограничивает число одновременных потоков скачивания на весь бот,
+# чтобы медиа не забивало соединение остальным запросам.
+
+class Downloader:
+    _slots = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+    @staticmethod
+    async def _fetch_part(media, out, start: int, end: int, size: int) -> int:
+        pos = start
+        async with Downloader._slots:
+            async for chunk in client.iter_download(
+                media,
+                offset=start,
+                request_size=DOWNLOAD_CHUNK_SIZE,
+                limit=math.ceil((end - start) / DOWNLOAD_CHUNK_SIZE),
+                file_size=size
+            ):
+                # seek + write без await между ними — части не перемешиваются
+                out.seek(pos)
+                out.write(chunk)
+                pos += len(chunk)
+        return pos - start
+
+    @staticmethod
+    async def _parallel(document, out, size: int):
+        part = math.ceil(size / DOWNLOAD_PARTS / DOWNLOAD_CHUNK_SIZE) * DOWNLOAD_CHUNK_SIZE
+        tasks = [
+            asyncio.create_task(Downloader._fetch_part(document, out, start, min(start + part, size), size))
+            for start in range(0, size, part)
+        ]
+        try:
+            done = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        if sum(done) != size:
+            raise IOError(f"скачано {sum(done)} из {size} байт")
+        out.seek(0, io.SEEK_END)
+
+    @staticmethod
+    async def download(msg, out):
+        """Скачивает медиа сообщения в файловый объект out (позиция — в конце файла)."""
+        size = getattr(msg.file, 'size', None) or 0
+        document = getattr(msg.media, 'document', None)
+        if document is not None and size >= DOWNLOAD_PARALLEL_MIN_SIZE:
+            try:
+                await Downloader._parallel(document, out, size)
+                return
+            except Exception as e:
+                logger.warning(f"[DOWNLOAD] Msg {msg.id}: параллельное скачивание не удалось ({e}), качаю одним потоком")
+                out.seek(0)
+                out.truncate()
+        async with Downloader._slots:
+            await msg.download_media(file=out)
+
+# ====== MEDIA STAGE ======
+# Медиа сообщения скачивается из Telegram один раз на всю рассылку в spool-файл:
+# небольшие файлы остаются в памяти, крупные уходят на диск. Основной канал,
+# доп. каналы и повторные попытки читают его через свой SpoolReader (со своей
+# позицией). Файл удаляется после завершения рассылки сообщения.
+# Медиа больше MAX_FILE_SIZE не скачивается вовсе — вместо него уходит заглушка.
+# Если этот файл (тот же photo/document id) уже заливался ботом — он отправляется
+# по сохранённому file_id, без скачивания и заливки.
+
+def media_key(msg, kind: str) -> str | None:
+    """Ключ файла для кэша file_id: id фото/документа в Telegram."""
+    photo = getattr(msg.media, 'photo', None)
+    if photo is not None and getattr(photo, 'id', None):
+        return f"photo:{photo.id}"
+    document = getattr(msg.media, 'document', None)
+    if document is not None and getattr(document, 'id', None):
+        # file_id видео из альбома отправляется как видео, а не документ
+        return f"{'video' if kind == 'video' else 'doc'}:{document.id}"
+    return None
+
+def sent_file_id(sent) -> str | None:
+    """file_id файла из отправленного ботом сообщения (для фото — самый большой размер)."""
+    attachment = getattr(sent, 'effective_attachment', None)
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, 'file_id', None)
+
+def media_kind(msg) -> str:
+    """Тип отправки через Bot API: photo / voice / document."""
+    if isinstance(msg.media, MessageMediaPhoto):
+        return "photo"
+    if (
+        hasattr(msg.media, 'document')
+        and any(hasattr(a, 'voice') and a.voice for a in msg.media.document.attributes)
+    ):
+        return "voice"
+    return "document"
+
+def album_kind(msg) -> str:
+    """Тип элемента альбома: photo / video / document (фото и видео можно смешивать)."""
+    if isinstance(msg.media, MessageMediaPhoto):
+        return "photo"
+    if getattr(msg, 'video', None) is not None:
+        return "video"
+    return "document"
+
+ALBUM_INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+class SpoolReader(io.RawIOBase):
+    """Независимый поток чтения поверх общего spool-файла."""
+
+    def __init__(self, spool, size: int, name: str):
+        super().__init__()
+        self._spool = spool
+        self._size = size
+        self._pos = 0
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, b) -> int:
+        # Чтение идёт синхронно в потоке event loop — seek + read не перемежаются
+        self._spool.seek(self._pos)
+        data = self._spool.read(min(len(b), max(0, self._size - self._pos)))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+class MediaStage:
+    def __init__(self, msg, in_album: bool = False):
+        self.msg = msg
+        self.kind = album_kind(msg) if in_album else media_kind(msg)
+        self.name = getattr(msg.file, 'name', 'file') or 'file'
+        self.size = getattr(msg.file, 'size', None) or 0
+        self.key = media_key(msg, self.kind)
+        self._file_id: str | None = None
+        self._file_id_loaded = False
+        self._file_id_lock = asyncio.Lock()
+        self._spool = None
+        self._spool_size = 0
+        self._lock = asyncio.Lock()
+        # Байты нужны ровно одной заливке (доп. каналы копируются или их нет) —
+        # их можно передать потоком, не сохраняя
+        self.stream_once = False
+
+    @property
+    def streamable(self) -> bool:
+        return (
+            self.stream_once
+            and 0 < STREAM_RELAY_MIN_SIZE <= self.size
+            and self.kind == "document"
+            and self._spool is None
+            and getattr(self.msg.media, 'document', None) is not None
+        )
+
+    @property
+    def oversized(self) -> bool:
+        return self.size > MAX_FILE_SIZE
+
+    def placeholder(self) -> str:
+        """HTML-заглушка вместо файла больше MAX_FILE_SIZE."""
+        return MEDIA_TOO_LARGE_TEXT.format(name=escape(self.name), size_mb=self.size / (1024 * 1024))
+
+    async def file_id(self) -> str | None:
+        """Сохранённый file_id этого файла или None, если его нужно заливать."""
+        async with self._file_id_lock:
+            if not self._file_id_loaded and self.key:
+                self._file_id_loaded = True
+                try:
+                    self._file_id = await DB.get_file_id(self.key)
+                except Exception as e:
+                    logger.warning(f"[MEDIA CACHE ERROR] {e}")
+        return self._file_id
+
+    def remember(self, sent):
+        """Запоминает file_id после успешной заливки (отправки по file_id не трогают кэш)."""
+        file_id = sent_file_id(sent)
+        if self.key and file_id and self._file_id is None:
+            self._file_id = file_id
+            DB.save_file_id(self.key, file_id)
+
+    def forget(self, file_id: str):
+        """Telegram отклонил file_id — удаляем его, дальше только заливка."""
+        logger.warning(f"[MEDIA CACHE] {self.key}: file_id отклонён, удаляю из кэша")
+        if self._file_id == file_id:
+            self._file_id = None
+        DB.drop_file_id(self.key, file_id)
+
+    async def open(self) -> SpoolReader:
+        """Новый поток для чтения; при первом вызове скачивает медиа."""
+        async with self._lock:
+            if self._spool is None:
+                spool = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY, dir=MEDIA_SPOOL_DIR)
+                try:
+                    await Downloader.download(self.msg, spool)
+                except BaseException:
+                    spool.close()
+                    raise
+                self._spool, self._spool_size = spool, spool.tell()
+                logger.info(
+                    f"[MEDIA] Msg {self.msg.id}: скачано {self._spool_size} байт ({self.kind}, "
+                    f"{'диск' if self._spool_size > MEDIA_SPOOL_MAX_MEMORY else 'память'})"
+                )
+        return SpoolReader(self._spool, self._spool_size, self.name)
+
+    def release(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+# ====== STREAM RELAY ======
+# Потоковая заливка: чанки из iter_download сразу уходят в multipart-тело sendDocument
+# (httpx, async generator с точным Content-Length). Скачивание и заливка идут
+# одновременно, в памяти — несколько чанков. PTB так не умеет (InputFile читает
+# файл целиком), поэтому запрос собирается вручную на том же base_url бота.
+
+class StreamRelay:
+    _http: httpx.AsyncClient | None = None
+
+    @staticmethod
+    def _client() -> httpx.AsyncClient:
+        if StreamRelay._http is None:
+            StreamRelay._http = httpx.AsyncClient(timeout=httpx.Timeout(STREAM_RELAY_TIMEOUT, connect=10))
+        return StreamRelay._http
+
+    @staticmethod
+    async def close():
+        if StreamRelay._http is not None:
+            await StreamRelay._http.aclose()
+            StreamRelay._http = None
+
+    @staticmethod
+    def _raise_for(data: dict):
+        """Ошибка Bot API -> исключение telegram.error, как у обычных вызовов PTB."""
+        description = data.get("description", "Unknown error")
+        retry_after = (data.get("parameters") or {}).get("retry_after")
+        if retry_after:
+            raise RetryAfter(retry_after)
+        if data.get("error_code") == 400:
+            raise BadRequest(description)
+        if data.get("error_code") == 403:
+            raise Forbidden(description)
+        raise NetworkError(description)
+
+    @staticmethod
+    async def send_document(media: MediaStage, fields: dict) -> Message:
+        msg, size = media.msg, media.size
+        boundary = os.urandom(16).hex()
+        head = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items() if value is not None
+        )
+        filename = media.name.replace('"', "'").replace("\r", " ").replace("\n", " ")
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+
+        async def body():
+            yield head
+            sent = 0
+            async with Downloader._slots:
+                async for chunk in client.iter_download(
+                    msg.media.document, request_size=DOWNLOAD_CHUNK_SIZE, file_size=size
+                ):
+                    chunk = bytes(chunk[:size - sent])
+                    sent += len(chunk)
+                    yield chunk
+                    if sent >= size:
+                        break
+            if sent != size:
+                raise IOError(f"скачано {sent} из {size} байт")
+            yield tail
+
+        await RateLimiter.acquire(fields["chat_id"])
+        response = await StreamRelay._client().post(
+            f"{bot_app.bot.base_url}/sendDocument",
+            content=body(),
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(head) + size + len(tail)),
+            },
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        # HTML-страница прокси (502/504) или 5xx — временная ошибка, а не отказ Bot API
+        if not isinstance(data, dict) or response.status_code >= 500:
+            raise NetworkError(f"Bot API HTTP {response.status_code}")
+        if not data.get("ok"):
+            StreamRelay._raise_for(data)
+        logger.info(f"[STREAM] Msg {msg.id}: {size} байт залито потоком")
+        return Message.de_json(data["result"], bot_app.bot)
+
 # ====== CORE SEND LOGIC ======
 # Выделена отдельная функция отправки в один канал — используется и для основного,
 # и для каждого доп. канала.
@@ -840,18 +2420,37 @@ async def send_to_target(
     chat_type: str,
     source_topic_title: str | None,
     auto_create_topics: bool,
+    media: MediaStage | None = None,
+    album: list[MediaStage] | None = None,
+    copy_from: tuple[int, int] | None = None,
     is_extra: bool = False
-) -> int | None:
+) -> tuple[list[int], int] | None:
     """
     Отправляет сообщение в указанный канал/топик.
-    Возвращает message_id отправленного сообщения или None при ошибке.
-
+    Возвращает (message_id отправленных сообщений, топик, в который они ушли):
+    для альбома — по id на элемент, в том же порядке. None — если попытки
+    исчерпаны или топик взять неоткуда. Ошибка, которую
+    повторы не исправят, пробрасывается (категория — SendErrors.classify).
+
+    media — общий для всей рассылки MediaStage (None для текстовых сообщений).
+    album — элементы альбома, уходят одним send_media_group; подпись ставится
+    на элемент msg (или на первый, если его нет среди отправляемых).
+    copy_from — (chat_id, message_id) уже доставленной копии: сообщение копируется
+    на стороне Telegram через copy_message, без повторной заливки. Если копирование
+    не удалось — отправка падает обратно на обычную заливку.
     is_extra=True — отправка в доп. канал (маппинг топиков берётся из extra_targets).
     """
 
     current_target_tid = target_tid
-
-    for attempt in range(2):
+    use_reply = True
+    cached_files = []  # [(MediaStage, file_id)] — отправленные по сохранённому file_id
+    # Переход с copy_message / file_id на заливку и повторы по флуд-контролю
+    # и сетевым ошибкам (их число ограничено SEND_MAX_RETRIES) не расходуют попытки
+    attempts = 2
+    retries = 0
+
+    while attempts > 0:
+        attempts -= 1
         if not current_target_tid:
             if not auto_create_topics:
                 logger.info(
@@ -866,22 +2465,17 @@ async def send_to_target(
                 f"Создаю топик для {chat_title} (source_topic={source_top_id}) "
                 f"в канале {target_chat}..."
             )
-            new_tid = await ForumManager.create_topic(target_chat, chat_title, s_tname=source_topic_title)
+            new_tid = await ForumManager.provision_topic(
+                target_chat, chat_id_str, source_top_id, chat_title, chat_type,
+                s_tname=source_topic_title, is_extra=is_extra
+            )
             if not new_tid:
                 return None
 
             current_target_tid = new_tid
 
-            if is_extra:
-                TopicManager.set_extra_topic(chat_id_str, target_chat, str(source_top_id), new_tid)
-            else:
-                TopicManager.register_source(
-                    int(chat_id_str), chat_title, chat_type,
-                    source_top_id, s_tname=source_topic_title, target_tid=new_tid
-                )
-
         try:
-            current_reply_id = reply_to_target_id if attempt == 0 else None
+            current_reply_id = reply_to_target_id if use_reply else None
             # Базовые kwargs — общие для всех типов отправки
             base_kwargs = {
                 "chat_id": target_chat,
@@ -889,88 +2483,529 @@ async def send_to_target(
                 "reply_to_message_id": current_reply_id,
             }
 
-            if msg.media:
+            if copy_from:
+                sent = await RateLimiter.call(
+                    target_chat, bot_app.bot.copy_message,
+                    from_chat_id=copy_from[0], message_id=copy_from[1], **base_kwargs
+                )
+                sent_ids = [sent.message_id]
+            elif album:
+                cached_files = []
+                caption_at = next((i for i, st in enumerate(album) if st.msg is msg), 0)
+                items = []
+                for i, st in enumerate(album):
+                    file_id = await st.file_id()
+                    if file_id:
+                        cached_files.append((st, file_id))
+                    caption = {"caption": prefixed_text, "parse_mode": "HTML"} if i == caption_at else {}
+                    items.append(ALBUM_INPUT_MEDIA[st.kind](media=file_id or await st.open(), **caption))
+
+                sent_group = await RateLimiter.call(
+                    target_chat, bot_app.bot.send_media_group, media=items, cost=len(items), **base_kwargs
+                )
+                for st, sent in zip(album, sent_group):
+                    st.remember(sent)
+                sent_ids = [sent.message_id for sent in sent_group]
+            elif media:
                 send_kwargs = {**base_kwargs, "parse_mode": "HTML", "caption": prefixed_text}
-                buf = io.BytesIO()
-                await msg.download_media(file=buf)
-                buf.seek(0)
-                buf.name = getattr(msg.file, 'name', 'file') or 'file'
-
-                if isinstance(msg.media, MessageMediaPhoto):
-                    sent = await bot_app.bot.send_photo(photo=buf, **send_kwargs)
-                elif (
-                    hasattr(msg.media, 'document')
-                    and any(hasattr(a, 'voice') and a.voice for a in msg.media.document.attributes)
-                ):
-                    sent = await bot_app.bot.send_voice(voice=buf, **send_kwargs)
+                file_id = await media.file_id()
+                cached_files = [(media, file_id)] if file_id else []
+
+                if not file_id and media.streamable:
+                    # Потоком — только первая попытка; повтор пойдёт обычным путём через spool
+                    media.stream_once = False
+                    sent = await StreamRelay.send_document(media, send_kwargs)
                 else:
-                    sent = await bot_app.bot.send_document(document=buf, **send_kwargs)
+                    buf = file_id or await media.open()
+                    if media.kind == "photo":
+                        sent = await RateLimiter.call(target_chat, bot_app.bot.send_photo, photo=buf, **send_kwargs)
+                    elif media.kind == "voice":
+                        sent = await RateLimiter.call(target_chat, bot_app.bot.send_voice, voice=buf, **send_kwargs)
+                    else:
+                        sent = await RateLimiter.call(target_chat, bot_app.bot.send_document, document=buf, **send_kwargs)
+                media.remember(sent)
+                sent_ids = [sent.message_id]
             else:
                 # link_preview_options поддерживается только в send_message
                 send_kwargs = {
                     **base_kwargs,
                     "link_preview_options": LinkPreviewOptions(is_disabled=True),
                 }
-                sent = await bot_app.bot.send_message(
+                sent = await RateLimiter.call(
+                    target_chat, bot_app.bot.send_message,
                     text=prefixed_text,
                     parse_mode="HTML",
                     **send_kwargs
                 )
+                sent_ids = [sent.message_id]
 
             logger.info(
-                f"[SUCCESS {'EXTRA' if is_extra else 'MAIN'}] "
+                f"[SUCCESS {'EXTRA' if is_extra else 'MAIN'}{' COPY' if copy_from else ''}] "
                 f"Msg {msg.id} (Source Topic:{source_top_id}) ➡️ "
-                f"Target Msg {sent.message_id} (Target Topic:{current_target_tid}) "
+                f"Target Msg {', '.join(map(str, sent_ids))} (Target Topic:{current_target_tid}) "
                 f"in chat {target_chat}"
             )
-            return sent.message_id
+            return sent_ids, int(current_target_tid)
 
         except Exception as e:
-            err_str = str(e)
-            if "Message thread not found" in err_str or "thread" in err_str.lower():
-                logger.warning(
-                    f"[RE-CREATE {'EXTRA' if is_extra else 'MAIN'}] "
-                    f"Ветка {current_target_tid} невалидна. Пересоздаю..."
+            category = SendErrors.record(e)
+            if await SendErrors.wait_before_retry(target_chat, e, category, retries):
+                retries += 1
+                attempts += 1
+                continue
+            elif category == "topic":
+                replacement = ForumManager.invalidate_topic(
+                    target_chat, chat_id_str, source_top_id, current_target_tid, is_extra
                 )
-                if is_extra:
-                    TopicManager.set_extra_topic(chat_id_str, target_chat, str(source_top_id), None)
+                if replacement:
+                    logger.info(
+                        f"[RE-CREATE {'EXTRA' if is_extra else 'MAIN'}] "
+                        f"Ветка {current_target_tid} уже заменена на {replacement}"
+                    )
                 else:
-                    db_data = TopicManager.load_db()
-                    if chat_id_str in db_data and str(source_top_id) in db_data[chat_id_str]['topics']:
-                        db_data[chat_id_str]['topics'][str(source_top_id)]['topic_id'] = None
-                        TopicManager.save_db(db_data)
-                current_target_tid = None
+                    logger.warning(
+                        f"[RE-CREATE {'EXTRA' if is_extra else 'MAIN'}] "
+                        f"Ветка {current_target_tid} невалидна. Пересоздаю..."
+                    )
+                current_target_tid = replacement
+                use_reply = False
+                continue
+            elif category == "reply" and use_reply:
+                use_reply = False
                 continue
-            elif "reply" in err_str.lower() or "Message to be replied not found" in err_str:
+            elif copy_from:
+                logger.warning(f"[COPY FALLBACK] Msg {msg.id} ➡️ {target_chat}: {e}. Отправляю заново")
+                copy_from = None
+                attempts += 1
+                continue
+            elif category == "file" and cached_files:
+                # wrong file identifier / can't use file of type ... — file_id устарел
+                for st, file_id in cached_files:
+                    st.forget(file_id)
+                cached_files = []
+                attempts += 1
                 continue
             else:
-                logger.error(f"[ERROR {'EXTRA' if is_extra else 'MAIN'}] {e}")
-                break
+                logger.error(f"[ERROR {'EXTRA' if is_extra else 'MAIN'} {category.upper()}] {e}")
+                raise
 
     return None
 
+# ====== OUTBOX ======
+# Все доставки идут через таблицу outbox: обработчик Telethon готовит текст и
+# маршрут и записывает задания (по одному на канал), диспетчер выбирает готовые
+# задания из очередей линий в памяти и доставляет их, сгруппировав по сообщению
+# источника.
+# Маппинг доставленного сообщения и удаление задания — одна транзакция.
+# Неудачная доставка откладывается с экспоненциальной задержкой; после
+# перезапуска сообщения заново берутся из Telegram через get_messages.
+# Линия — источник + ветка (message_lane), порядок соблюдается для каждого канала
+# назначения отдельно: в один канал сообщения линии доставляются строго по одному
+# в порядке поступления, разные линии и каналы — параллельно, до
+# OUTBOX_CONCURRENCY сообщений одновременно. Отложенное после ошибки задание
+# держит свою линию в своём канале до повтора (другие каналы его не ждут); с
+# OUTBOX_SKIP_RETRYING следующие за ним доставляются без ожидания.
+
+class Outbox:
+    _live = {}          # (src_chat_id, src_id) -> живые объекты Telethon и число недоставленных каналов
+    _inflight = {}      # (src_chat_id, src_id) -> линии (линия, канал) сообщения, которое сейчас доставляется
+    _queues = {}        # (линия, канал) -> очередь заданий в порядке поступления
+    _entries = {}       # (src_chat_id, src_id, tgt_chat_id) -> задание в очереди своей линии
+    _tasks = set()
+    _wakeup = asyncio.Event()
+    _runner = None
+
+    @staticmethod
+    async def enqueue(src_chat_id, msg, album_msgs: list | None, lane: str, payload: dict, targets: list[dict]):
+        """Записывает задания доставки (ждёт записи на диск) и будит диспетчер."""
+        DB.cache_new(src_chat_id, [m.id for m in album_msgs or [msg]])
+        Outbox._live[(src_chat_id, msg.id)] = {
+            "msg": msg,
+            "by_id": {m.id: m for m in album_msgs or [msg]},
+            "left": len(targets),
+        }
+        now = time.time()
+        await DB.commit([(
+            'INSERT OR REPLACE INTO outbox '
+            '(src_chat_id, src_id, tgt_chat_id, is_extra, payload, attempts, next_attempt_at, created_at, lane) '
+            'VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)',
+            (src_chat_id, msg.id, target["tgt_chat_id"], int(target["is_extra"]),
+             json.dumps({**payload, "tid": target["tid"], "reply_id": target["reply_id"]}, ensure_ascii=False),
+             now, now, lane)
+        ) for target in targets])
+        for target in targets:
+            Outbox._track(src_chat_id, msg.id, target["tgt_chat_id"], lane, now, now)
+        Outbox._wakeup.set()
+
+    # ------------------------------------------------------------------ #
+    # Очереди линий: порядок и готовность заданий держатся в памяти, чтобы
+    # диспетчер не перебирал таблицу на каждом проходе. Таблица читается
+    # целиком один раз — при старте.
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _track(src_chat_id, src_id, tgt_chat_id, lane: str, created_at: float, next_at: float):
+        entry = Outbox._entries.get((src_chat_id, src_id, tgt_chat_id))
+        if entry is not None:
+            entry["next_at"] = next_at
+            return
+        entry = {
+            "key": (src_chat_id, src_id),
+            "tgt_chat_id": tgt_chat_id,
+            # Задания, записанные до появления линий: каждое сообщение — своя линия
+            "lane": (lane or f"msg:{src_chat_id}:{src_id}", tgt_chat_id),
+            "order": (created_at, src_id),
+            "next_at": next_at,
+        }
+        Outbox._entries[(src_chat_id, src_id, tgt_chat_id)] = entry
+        queue_ = Outbox._queues.setdefault(entry["lane"], deque())
+        # Обычно задание новее всех в очереди; старые приходят только при загрузке
+        pos = len(queue_)
+        while pos and queue_[pos - 1]["order"] > entry["order"]:
+            pos -= 1
+        queue_.insert(pos, entry)
+
+    @staticmethod
+    def _untrack(src_chat_id, src_id, tgt_chat_id):
+        entry = Outbox._entries.pop((src_chat_id, src_id, tgt_chat_id), None)
+        if entry is None:
+            return
+        queue_ = Outbox._queues[entry["lane"]]
+        queue_.remove(entry)
+        if not queue_:
+            del Outbox._queues[entry["lane"]]
+
+    @staticmethod
+    def _load_sync() -> list:
+        return DB.connection().execute(
+            'SELECT src_chat_id, src_id, tgt_chat_id, lane, created_at, next_attempt_at FROM outbox'
+        ).fetchall()
+
+    @staticmethod
+    def _due(now: float, free: int) -> dict:
+        """Готовые первые задания свободных линий: {(src_chat_id, src_id): [задание, ...]}."""
+        busy = {lane for lanes in Outbox._inflight.values() for lane in lanes}
+        heads = []
+        for lane, queue_ in Outbox._queues.items():
+            if lane in busy:
+                continue
+            if OUTBOX_SKIP_RETRYING:
+                entry = next((e for e in queue_ if e["next_at"] <= now), None)
+            else:
+                # Пока первое задание ждёт повтора, линия стоит
+                entry = queue_[0]
+            if entry is None or entry["next_at"] > now or entry["key"] in Outbox._inflight:
+                continue
+            heads.append(entry)
+        heads.sort(key=lambda e: e["order"])
+        groups = {}
+        for entry in heads:
+            if entry["key"] in groups or len(groups) < free:
+                groups.setdefault(entry["key"], []).append(entry)
+        return groups
+
+    @staticmethod
+    async def run():
+        """Диспетчер: выбирает готовые задания и запускает доставку, по сообщению на линию."""
+        rows = await DB._read(Outbox._load_sync)
+        for row in rows:
+            Outbox._track(*row)
+        if rows:
+            logger.info(f"[OUTBOX] Недоставленных заданий с прошлого запуска: {len(rows)}")
+        while True:
+            Outbox._wakeup.clear()
+            free = OUTBOX_CONCURRENCY - len(Outbox._inflight)
+            if free > 0:
+                for key, entries in Outbox._due(time.time(), free).items():
+                    Outbox._inflight[key] = [entry["lane"] for entry in entries]
+                    task = asyncio.create_task(Outbox._process(key, [entry["tgt_chat_id"] for entry in entries]))
+                    Outbox._tasks.add(task)
+                    task.add_done_callback(Outbox._tasks.discard)
+            try:
+                await asyncio.wait_for(Outbox._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def start():
+        Outbox._runner = asyncio.create_task(Outbox.run())
+
+    @staticmethod
+    async def stop():
+        """Останавливает доставку; незавершённые задания остаются в outbox до следующего запуска."""
+        tasks = [t for t in (Outbox._runner, *Outbox._tasks) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _refetch(payload: dict):
+        """Сообщение источника после перезапуска: (msg, {id: message}) или None, если удалено."""
+        ids = [payload["lead_id"]] + [i for i in payload["media_ids"] if i != payload["lead_id"]]
+        fetched = await client.get_messages(payload["peer_id"], ids=ids)
+        by_id = {m.id: m for m in fetched if m}
+        msg = by_id.get(payload["lead_id"])
+        return (msg, by_id) if msg else None
+
+    @staticmethod
+    def _delete_op(src_chat_id, src_id, tgt_chat_id) -> tuple:
+        return (
+            'DELETE FROM outbox WHERE src_chat_id = ? AND src_id = ? AND tgt_chat_id = ?',
+            (src_chat_id, src_id, tgt_chat_id)
+        )
+
+    @staticmethod
+    def _finish(key, tgt_chat_id, ops: list, next_at: float | None = None) -> asyncio.Future:
+        """
+        Ставит изменения задания в запись; сообщение держит линию, пока они не закоммичены.
+        next_at — время повтора отложенного задания, None — задание завершено.
+        """
+        if next_at is None:
+            Outbox._untrack(*key, tgt_chat_id)
+            live = Outbox._live.get(key)
+            if live:
+                live["left"] -= 1
+                if live["left"] <= 0:
+                    Outbox._live.pop(key, None)
+        else:
+            entry = Outbox._entries.get((*key, tgt_chat_id))
+            if entry is not None:
+                entry["next_at"] = next_at
+        return asyncio.ensure_future(DB.commit(ops))
+
+    @staticmethod
+    def _result(key, job, links, actual_tid, category) -> asyncio.Future:
+        src_chat_id, src_id = key
+        tgt_chat_id = job["tgt_chat_id"]
+        label = 'EXTRA' if job["is_extra"] else 'MAIN'
+        if links:
+            ops = DB.link_ops(
+                src_chat_id, links, tgt_chat_id, actual_tid,
+                extra=job["is_extra"], as_text=not job["media_ids"]
+            )
+            return Outbox._finish(key, tgt_chat_id, ops + [Outbox._delete_op(src_chat_id, src_id, tgt_chat_id)])
+        elif category == "fatal" or job["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(
+                f"[FATAL {label}] Не удалось отправить {src_id} в {tgt_chat_id} "
+                f"(попыток: {job['attempts'] + 1}, {category}) — задание удалено"
+            )
+            return Outbox._finish(key, tgt_chat_id, [Outbox._delete_op(src_chat_id, src_id, tgt_chat_id)])
+        else:
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** job["attempts"])
+            logger.warning(f"[OUTBOX RETRY {label}] Msg {src_id} ➡️ {tgt_chat_id}: повтор через {delay} сек")
+            next_at = time.time() + delay
+            return Outbox._finish(key, tgt_chat_id, [(
+                'UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? '
+                'WHERE src_chat_id = ? AND src_id = ? AND tgt_chat_id = ?',
+                (next_at, src_chat_id, src_id, tgt_chat_id)
+            )], next_at)
+
+    @staticmethod
+    def _jobs_sync(src_chat_id, src_id) -> list:
+        return DB.connection().execute(
+            'SELECT tgt_chat_id, is_extra, payload, attempts FROM outbox WHERE src_chat_id = ? AND src_id = ?',
+            (src_chat_id, src_id)
+        ).fetchall()
+
+    @staticmethod
+    async def _process(key, targets: list):
+        src_chat_id, src_id = key
+        stages = []
+        resolved = set()
+        commits = []  # записи результатов; линия освобождается после их фиксации
+        jobs = []
+
+        def on_result(job, links, actual_tid, category):
+            resolved.add(job["tgt_chat_id"])
+            commits.append(Outbox._result(key, job, links, actual_tid, category))
+
+        try:
+            rows = {row[0]: row for row in await DB._read(Outbox._jobs_sync, src_chat_id, src_id)}
+            for tgt_chat_id in targets:
+                if tgt_chat_id not in rows:
+                    Outbox._untrack(src_chat_id, src_id, tgt_chat_id)  # строки уже нет
+                    continue
+                _, is_extra, payload, attempts = rows[tgt_chat_id]
+                jobs.append({
+                    **json.loads(payload), "tgt_chat_id": tgt_chat_id, "is_extra": bool(is_extra), "attempts": attempts
+                })
+            if not jobs:
+                return
+            payload = jobs[0]
+
+            live = Outbox._live.get(key)
+            if live:
+                msg, by_id = live["msg"], live["by_id"]
+            else:
+                fetched = await Outbox._refetch(payload)
+                if fetched is None:
+                    logger.warning(f"[OUTBOX] Сообщение {src_id} из {src_chat_id} удалено — задания сняты")
+                    for job in jobs:
+                        resolved.add(job["tgt_chat_id"])
+                        commits.append(Outbox._finish(
+                            key, job["tgt_chat_id"], [Outbox._delete_op(src_chat_id, src_id, job["tgt_chat_id"])]
+                        ))
+                    return
+                msg, by_id = fetched
+
+            stages = [MediaStage(by_id[i], in_album=payload["album"]) for i in payload["media_ids"] if i in by_id]
+            # send_media_group требует минимум 2 элемента
+            media = stages[0] if len(stages) == 1 else None
+            album = stages if len(stages) > 1 else None
+
+            # Основной канал доставлен раньше — доп. каналы копируют из него
+            copy_source = None
+            if FANOUT_MODE == "copy" and media and all(job["is_extra"] for job in jobs):
+                main = (await DB.resolve_all(src_chat_id, media.msg.id)).get(payload["target_chat"])
+                if main and not main["extra"]:
+                    copy_source = (main["tgt_chat_id"], main["tgt_id"])
+
+            await deliver_message(msg, payload, jobs, media, album, copy_source, on_result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[OUTBOX ERROR] Msg {src_id} из {src_chat_id}: {e}")
+            for job in jobs:
+                if job["tgt_chat_id"] not in resolved:
+                    commits.append(Outbox._result(key, job, None, None, "transient"))
+            # Задания не прочитались из базы — повтор позже, без учёта попытки
+            for tgt_chat_id in set(targets) - {job["tgt_chat_id"] for job in jobs}:
+                entry = Outbox._entries.get((src_chat_id, src_id, tgt_chat_id))
+                if entry is not None:
+                    entry["next_at"] = time.time() + OUTBOX_RETRY_BASE
+        finally:
+            for st in stages:
+                st.release()
+            # Иначе диспетчер может прочитать outbox раньше writer-потока
+            # и выдать то же задание повторно
+            try:
+                for err in await asyncio.gather(*commits, return_exceptions=True):
+                    if isinstance(err, BaseException):
+                        logger.error(f"[OUTBOX ERROR] Msg {src_id} из {src_chat_id}: запись результата: {err}")
+            finally:
+                Outbox._inflight.pop(key, None)
+                Outbox._wakeup.set()
+
 # ====== TELETHON HANDLERS ======
+# Telethon запускает обработчик каждого события отдельной задачей. Чтобы сообщения
+# одной линии не обгоняли друг друга на запросах до записи в outbox, обработчик
+# занимает замок линии до первого await (asyncio.Lock пропускает ждущих по порядку).
+# Альбом Telethon отдаёт событием Album с задержкой, поэтому линию занимает уже
+# первый его элемент (NewMessage с grouped_id) и держит до обработки альбома.
+
+class Lanes:
+    _locks = {}   # линия -> [замок, число обработчиков]
+    _albums = {}  # grouped_id -> {"lane", "ready": Future, "expire": TimerHandle}
+
+    @staticmethod
+    async def acquire(lane: str):
+        entry = Lanes._locks.setdefault(lane, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            Lanes._release_entry(lane, entry, locked=False)
+            raise
+
+    @staticmethod
+    def _release_entry(lane: str, entry: list, locked: bool = True):
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            Lanes._locks.pop(lane, None)
+
+    @staticmethod
+    def release(lane: str):
+        Lanes._release_entry(lane, Lanes._locks[lane])
+
+    @staticmethod
+    async def reserve_album(grouped_id, lane: str):
+        """Занимает линию для альбома по первому его элементу (повторные вызовы ничего не делают)."""
+        if grouped_id in Lanes._albums:
+            return
+        loop = asyncio.get_running_loop()
+        reservation = {"lane": lane, "ready": loop.create_future(), "expire": None}
+        Lanes._albums[grouped_id] = reservation
+        try:
+            await Lanes.acquire(lane)
+        except BaseException:
+            Lanes._albums.pop(grouped_id, None)
+            reservation["ready"].cancel()
+            raise
+        reservation["ready"].set_result(None)
+        reservation["expire"] = loop.call_later(ALBUM_LANE_TIMEOUT, Lanes._expire_album, grouped_id, reservation)
+
+    @staticmethod
+    def _expire_album(grouped_id, reservation: dict):
+        if Lanes._albums.get(grouped_id) is reservation:
+            del Lanes._albums[grouped_id]
+            logger.warning(f"[ALBUM] Альбом {grouped_id} не пришёл за {ALBUM_LANE_TIMEOUT} сек — линия освобождена")
+            Lanes.release(reservation["lane"])
+
+    @staticmethod
+    async def take_album(grouped_id) -> str | None:
+        """Забирает линию, занятую для альбома: её замок уже взят. None — брони нет."""
+        reservation = Lanes._albums.get(grouped_id)
+        if reservation is None:
+            return None
+        try:
+            await asyncio.shield(reservation["ready"])
+        except asyncio.CancelledError:
+            if not reservation["ready"].cancelled():
+                raise
+            return None
+        if Lanes._albums.get(grouped_id) is not reservation:
+            return None  # бронь истекла
+        del Lanes._albums[grouped_id]
+        reservation["expire"].cancel()
+        return reservation["lane"]
 
 async def telethon_handler(event):
-    msg = event.message
+    # Элементы альбома приходят и сюда, но пересылаются целиком в telethon_album_handler;
+    # здесь первый элемент только занимает линию, чтобы альбом не обогнали
+    if event.message.grouped_id:
+        await Lanes.reserve_album(event.message.grouped_id, message_lane(event.chat_id, event.message))
+        return
+    await process_message(event, event.message)
+
+async def telethon_album_handler(event):
+    messages = event.messages
+    # Подпись альбома — в одном из элементов, по нему строится текст и reply
+    lead = next((m for m in messages if m.message), messages[0])
+    await process_message(event, lead, album_msgs=messages)
+
+async def process_message(event, msg, album_msgs: list | None = None):
+    """
+    Пересылка нового сообщения (или альбома целиком: album_msgs — все элементы,
+    msg — элемент с подписью). Сообщения одной линии ставятся в outbox по порядку.
+    """
+    lane = await Lanes.take_album(msg.grouped_id) if album_msgs else None
+    if lane is None:
+        lane = message_lane(event.chat_id, msg)
+        await Lanes.acquire(lane)
+    try:
+        await prepare_delivery(event, msg, album_msgs, lane)
+    finally:
+        Lanes.release(lane)
+
+async def prepare_delivery(event, msg, album_msgs: list | None, lane: str):
+    """Маршрут, текст и задания доставки для сообщения (вызывается под замком линии)."""
     if msg.sender_id in EXCLUDED_SENDERS:
         return
 
     chat = await event.get_chat()
     sender = await event.get_sender()
 
-    log_full_message(event, tag="NEW")
+    for logged in album_msgs or [msg]:
+        log_full_message(event, tag="NEW", msg=logged)
 
     chat_title = getattr(chat, 'title', getattr(chat, 'first_name', 'Unknown'))
     is_private = isinstance(chat, User)
     chat_type = "private" if is_private else ("channel" if getattr(chat, 'broadcast', False) else "group")
 
-    db_data = TopicManager.load_db()
     chat_id_str = str(chat.id)
-    chat_conf = db_data.get(chat_id_str, {})
-    auto_create_topics = chat_conf.get("auto_create_topics", True)
-
-    final_target_chat = chat_conf.get('custom_target_id') or DEFAULT_TARGET_CHAT_ID
+    chat_conf = TopicManager.get_source(chat_id_str) or {}
 
     # ===== Имя + маркер =====
     sender_id = getattr(sender, "id", None)
@@ -987,16 +3022,21 @@ async def telethon_handler(event):
     # ===== Source topic =====
     source_top_id = resolve_source_topic_id(msg, chat, chat_conf)
 
-    # ===== Reply mapping =====
-    reply_to_target_id = None
-    reply_mapping = None
+    # ===== Маршрут (основной канал, топик, пауза, доп. каналы) =====
+    route = TopicManager.get_route(chat_id_str, source_top_id)
+    final_target_chat = route["target_chat"]
+    auto_create_topics = route["auto_create_topics"]
+    status = route["status"]
+
+    # ===== Reply mapping (все каналы одним запросом) =====
+    reply_targets = {}
     if msg.reply_to and hasattr(msg.reply_to, 'reply_to_msg_id'):
-        reply_mapping = DB.get(msg.reply_to.reply_to_msg_id)
-        if reply_mapping:
-            reply_to_target_id = reply_mapping['tgt_id']
+        reply_targets = await DB.resolve_all(chat.id, msg.reply_to.reply_to_msg_id)
+    reply_mapping = reply_targets.get(final_target_chat)
+    reply_to_target_id = reply_mapping['tgt_id'] if reply_mapping else None
 
     # ===== Target topic (основной канал) =====
-    target_tid = chat_conf.get('topics', {}).get(str(source_top_id), {}).get('topic_id')
+    target_tid = route["target_tid"]
     if not target_tid and reply_mapping:
         target_tid = reply_mapping.get('tid')
     if target_tid is not None and int(target_tid) <= 1:
@@ -1010,7 +3050,6 @@ async def telethon_handler(event):
         f"reply_to_msg_id={getattr(getattr(msg, 'reply_to', None), 'reply_to_msg_id', None)}"
     )
 
-    status = TopicManager.get_status(chat.id, source_top_id)
     if status == "paused":
         logger.info(f"[SKIP] Message {msg.id} skipped because topic {source_top_id} is disabled")
         return
@@ -1044,88 +3083,178 @@ async def telethon_handler(event):
         )
         return
 
-    # ====================================================
-    # ОТПРАВКА В ОСНОВНОЙ КАНАЛ
-    # ====================================================
-    sent_main_id = await send_to_target(
-        msg=msg,
-        prefixed_text=prefixed_text,
-        target_chat=final_target_chat,
-        target_tid=target_tid,
-        reply_to_target_id=reply_to_target_id,
-        chat=chat,
-        chat_id_str=chat_id_str,
-        source_top_id=source_top_id,
-        chat_title=chat_title,
-        chat_type=chat_type,
-        source_topic_title=source_topic_title,
-        auto_create_topics=auto_create_topics,
-        is_extra=False
-    )
+    # ===== Медиа: элементы больше MAX_FILE_SIZE заменяются заглушкой =====
+    media_ids = []
+    for m in album_msgs or [msg]:
+        if not m.media:
+            continue
+        st = MediaStage(m, in_album=bool(album_msgs))
+        if st.oversized:
+            logger.warning(
+                f"[MEDIA TOO LARGE] Msg {m.id}: {st.size} байт > {MAX_FILE_SIZE}, отправляю заглушку"
+            )
+            prefixed_text = f"{prefixed_text}\n\n{st.placeholder()}"
+        else:
+            media_ids.append(m.id)
+
+    # ===== Задания доставки: основной канал + доп. каналы =====
+    targets = [{"tgt_chat_id": final_target_chat, "is_extra": False, "tid": target_tid, "reply_id": reply_to_target_id}]
+    for extra_chat_id, extra_target_tid in route["extras"]:
+        if extra_chat_id == final_target_chat:
+            continue  # канал уже основной
+        extra_reply = reply_targets.get(extra_chat_id)
+        targets.append({
+            "tgt_chat_id": extra_chat_id,
+            "is_extra": True,
+            "tid": extra_target_tid,
+            "reply_id": extra_reply["tgt_id"] if extra_reply else None,
+        })
+    if not auto_create_topics:
+        for target in [t for t in targets if not t["tid"]]:
+            logger.info(
+                f"[SKIP AUTO CREATE {'EXTRA' if target['is_extra'] else 'MAIN'}] "
+                f"chat={chat_id_str}, title={chat_title}, target={target['tgt_chat_id']}, "
+                f"source_topic={source_top_id} — автосоздание выключено"
+            )
+            targets.remove(target)
+    if not targets:
+        return
 
-    if sent_main_id:
-        # Перечитываем db после возможного обновления в send_to_target
-        db_data = TopicManager.load_db()
-        chat_conf = db_data.get(chat_id_str, {})
-        actual_tid = chat_conf.get('topics', {}).get(str(source_top_id), {}).get('topic_id') or target_tid
-        DB.save(msg.id, final_target_chat, sent_main_id, int(actual_tid))
+    await Outbox.enqueue(chat.id, msg, album_msgs, lane, {
+        "peer_id": event.chat_id,
+        "lead_id": msg.id,
+        "media_ids": media_ids,
+        "album": bool(album_msgs),
+        "prefixed_text": prefixed_text,
+        "target_chat": final_target_chat,
+        "chat_id_str": chat_id_str,
+        "source_top_id": source_top_id,
+        "chat_title": chat_title,
+        "chat_type": chat_type,
+        "source_topic_title": source_topic_title,
+        "auto_create_topics": auto_create_topics,
+    }, targets)
+
+async def deliver_message(
+    msg,
+    payload: dict,
+    jobs: list[dict],
+    media: MediaStage | None,
+    album: list[MediaStage] | None,
+    copy_source: tuple[int, int] | None,
+    on_result
+):
+    """
+    Рассылка одного сообщения (или альбома) во все каналы jobs одновременно.
+    Каждый канал — со своим таймаутом, ошибка одного не мешает остальным.
+
+    payload — общие поля рассылки (см. process_message), jobs — каналы
+    ({"tgt_chat_id", "is_extra", "tid", "reply_id"}). copy_source — уже доставленная
+    в основной канал копия, если основного канала нет среди jobs.
+    on_result(job, links, actual_tid, category) вызывается сразу по завершении
+    доставки в канал: links — [(src_id, tgt_id)] или None при неудаче.
+    """
+    prefixed_text = payload["prefixed_text"]
+    chat_id_str = payload["chat_id_str"]
+    source_top_id = payload["source_top_id"]
+
+    # Исходные сообщения в порядке отправленных: элементы альбома или одно сообщение
+    if album:
+        members = [st.msg for st in album]
+    elif media:
+        members = [media.msg]
     else:
-        logger.error(f"[FATAL MAIN] Не удалось отправить {msg.id}")
+        members = [msg]
+    main_job = next((job for job in jobs if not job["is_extra"]), None)
+    if media:
+        # Доп. каналы берут медиа копией из основного — байты нужны одной заливке
+        media.stream_once = len(jobs) == 1 or (FANOUT_MODE == "copy" and main_job is not None)
+    # В режиме copy медиа в доп. каналы идёт из доставленного в основной
+    # (copy_message или file_id, сохранённые при заливке) — они ждут основной канал
+    wait_main = FANOUT_MODE == "copy" and bool(media or album) and main_job is not None
+
+    async def deliver_to(job, copy_from=None) -> list[int] | None:
+        target_chat, is_extra = job["tgt_chat_id"], job["is_extra"]
+        category = "transient"
+        try:
+            sent = await asyncio.wait_for(
+                send_to_target(
+                    msg=msg,
+                    prefixed_text=prefixed_text,
+                    target_chat=target_chat,
+                    target_tid=job["tid"],
+                    reply_to_target_id=job["reply_id"],
+                    chat=None,
+                    chat_id_str=chat_id_str,
+                    source_top_id=source_top_id,
+                    chat_title=payload["chat_title"],
+                    chat_type=payload["chat_type"],
+                    source_topic_title=payload["source_topic_title"],
+                    auto_create_topics=payload["auto_create_topics"],
+                    media=media,
+                    album=album,
+                    copy_from=copy_from,
+                    is_extra=is_extra
+                ),
+                DELIVERY_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            sent = None
+            logger.error(
+                f"[TIMEOUT {'EXTRA' if is_extra else 'MAIN'}] Msg {msg.id} ➡️ {target_chat}: "
+                f"не доставлено за {DELIVERY_TIMEOUT} сек"
+            )
+        except Exception as e:
+            sent = None
+            category = SendErrors.classify(e)
+            logger.error(f"[ERROR {'EXTRA' if is_extra else 'MAIN'}] Msg {msg.id} ➡️ {target_chat}: {e}")
 
-    # ====================================================
-    # ОТПРАВКА В ДОПОЛНИТЕЛЬНЫЕ КАНАЛЫ
-    # ====================================================
-    extra_targets = TopicManager.get_extra_targets(chat_id_str)
+        if not sent:
+            on_result(job, None, None, category)
+            return None
 
-    for et in extra_targets:
-        extra_chat_id = et["chat_id"]
-
-        # Получаем reply_to для доп. канала из таблицы msg_map_extra
-        extra_reply_id = None
-        if msg.reply_to and hasattr(msg.reply_to, 'reply_to_msg_id'):
-            extra_mappings = DB.get_extra(msg.reply_to.reply_to_msg_id)
-            for em in extra_mappings:
-                if em["tgt_chat_id"] == extra_chat_id:
-                    extra_reply_id = em["tgt_id"]
-                    break
+        # Топик — тот, в который сообщение реально ушло (мог быть создан заново)
+        sent_ids, actual_tid = sent
+        on_result(job, [(m.id, t) for m, t in zip(members, sent_ids)], actual_tid, None)
+        return sent_ids
 
-        # Целевой топик для этого доп. канала
-        extra_target_tid = TopicManager.get_extra_topic(chat_id_str, extra_chat_id, source_top_id)
-        if extra_target_tid is not None and int(extra_target_tid) <= 1:
-            extra_target_tid = None
-
-        sent_extra_id = await send_to_target(
-            msg=msg,
-            prefixed_text=prefixed_text,
-            target_chat=extra_chat_id,
-            target_tid=extra_target_tid,
-            reply_to_target_id=extra_reply_id,
-            chat=chat,
-            chat_id_str=chat_id_str,
-            source_top_id=source_top_id,
-            chat_title=chat_title,
-            chat_type=chat_type,
-            source_topic_title=source_topic_title,
-            auto_create_topics=auto_create_topics,
-            is_extra=True
-        )
+    # ====================================================
+    # ДОПОЛНИТЕЛЬНЫЕ КАНАЛЫ (в режиме copy — после основного)
+    # ====================================================
+    async def deliver_extra(job):
+        copy_from = copy_source if media else None
+        if wait_main:
+            sent_main_ids = await main_task
+            if media and sent_main_ids:
+                copy_from = (main_job["tgt_chat_id"], sent_main_ids[0])
+        await deliver_to(job, copy_from)
 
-        if sent_extra_id:
-            # Обновляем actual tid из конфига (мог обновиться в send_to_target)
-            actual_extra_tid = (
-                TopicManager.get_extra_topic(chat_id_str, extra_chat_id, source_top_id)
-                or extra_target_tid
-            )
-            DB.save_extra(msg.id, extra_chat_id, sent_extra_id, int(actual_extra_tid))
-        else:
-            logger.error(f"[FATAL EXTRA] Не удалось отправить {msg.id} в доп. канал {extra_chat_id}")
+    # ====================================================
+    # ОСНОВНОЙ КАНАЛ
+    # ====================================================
+    main_task = asyncio.create_task(deliver_to(main_job)) if main_job else None
+    # Ошибка одного канала не обрывает остальные: общий spool и линия
+    # освобождаются только после того, как закончат все
+    results = await asyncio.gather(
+        *([main_task] if main_task else []),
+        *(deliver_extra(job) for job in jobs if job["is_extra"]),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
 
 async def telethon_edit_handler(event):
-    log_full_message(event, tag="EDIT")
     msg = event.message
-    rel = DB.get(msg.id)
+    src_chat_id = int(normalize_chat_id(event.chat_id))
+    # Правки в чатах, которые никогда не пересылались, отбрасываем в памяти
+    if not DB.maybe_mirrored(src_chat_id, msg.id):
+        return
+
+    log_full_message(event, tag="EDIT")
+    targets = await DB.resolve_all(src_chat_id, msg.id)
 
-    if not rel:
+    if not targets:
         logger.warning(f"[EDIT] Нет маппинга для сообщения {msg.id}")
         return
 
@@ -1148,43 +3277,48 @@ async def telethon_edit_handler(event):
         user_marker = get_user_marker(sender_id)
         updated_text = build_prefixed_html(sender_name, user_marker, msg, edited=True)
 
-        # ===== Редактируем в основном канале =====
-        logger.info(f"[EDIT MAIN] Обновляю сообщение {rel['tgt_id']} в {rel['tgt_chat_id']}")
-        await _edit_message(rel['tgt_chat_id'], rel['tgt_id'], msg, updated_text)
-
-        # ===== Редактируем во всех доп. каналах =====
-        extra_rels = DB.get_extra(msg.id)
-        for er in extra_rels:
-            logger.info(f"[EDIT EXTRA] Обновляю {er['tgt_id']} в {er['tgt_chat_id']}")
-            await _edit_message(er['tgt_chat_id'], er['tgt_id'], msg, updated_text)
+        # ===== Редактируем в основном и во всех доп. каналах =====
+        # Снимок: пока идут правки, доставка в другой канал может дополнить запись кэша
+        for rel in list(targets.values()):
+            logger.info(
+                f"[EDIT {'EXTRA' if rel['extra'] else 'MAIN'}] "
+                f"Обновляю сообщение {rel['tgt_id']} в {rel['tgt_chat_id']}"
+            )
+            await _edit_message(rel['tgt_chat_id'], rel['tgt_id'], msg, updated_text, rel.get('as_text'))
 
     except Exception as e:
         logger.error(f"[EDIT ERROR] {e}")
 
-async def _edit_message(target_chat: int, target_msg_id: int, msg, updated_text: str):
-    """Вспомогательная функция: редактирует одно сообщение в одном канале."""
+async def _edit_message(target_chat: int, target_msg_id: int, msg, updated_text: str, as_text: bool | None = None):
+    """
+    Вспомогательная функция: редактирует одно сообщение в одном канале.
+    as_text — копия отправлена текстом (None — неизвестно, решает msg.media).
+    """
+    if as_text is None:
+        as_text = not msg.media
+    if not as_text:
+        method, payload = bot_app.bot.edit_message_caption, {"caption": updated_text}
+    else:
+        stage = MediaStage(msg) if msg.media else None
+        if stage and stage.oversized:
+            # Медиа не пересылалось (больше MAX_FILE_SIZE) — заглушка остаётся в тексте
+            updated_text = f"{updated_text}\n\n{stage.placeholder()}"
+        method, payload = bot_app.bot.edit_message_text, {"text": updated_text}
     try:
-        if msg.media:
-            await bot_app.bot.edit_message_caption(
-                chat_id=target_chat,
-                message_id=target_msg_id,
-                caption=updated_text,
-                parse_mode="HTML"
-            )
-        else:
-            await bot_app.bot.edit_message_text(
-                chat_id=target_chat,
-                message_id=target_msg_id,
-                text=updated_text,
-                parse_mode="HTML"
-            )
+        await SendErrors.retrying(target_chat, lambda: RateLimiter.call(
+            target_chat, method,
+            chat_id=target_chat,
+            message_id=target_msg_id,
+            parse_mode="HTML",
+            **payload
+        ))
         logger.info(f"[EDIT OK] {target_msg_id} в {target_chat} обновлено")
     except Exception as e:
         logger.error(f"[EDIT MSG ERROR] chat={target_chat}, msg={target_msg_id}: {e}")
 
-def log_full_message(event, tag="NEW"):
+def log_full_message(event, tag="NEW", msg=None):
     try:
-        msg = event.message
+        msg = msg or event.message
         chat = event.chat
         sender = event.sender
 
@@ -1220,12 +3354,19 @@ def log_full_message(event, tag="NEW"):
 async def main():
     global client, bot_app
     DB.init()
+    TopicManager.init()
+    DB.start()
+    migration_task = asyncio.create_task(DB.migrate_legacy())
+    retention_task = asyncio.create_task(DB.retention_loop())
+    filter_task = asyncio.create_task(DB.load_mirror_filter())
     prune_old_logs()
 
     bot_app = ApplicationBuilder().token(BOT_TOKEN).build()
     bot_app.add_handler(CommandHandler("list", cmd_list))
     bot_app.add_handler(CommandHandler("log", cmd_log))
     bot_app.add_handler(CommandHandler("bindtopic", cmd_bindtopic))
+    bot_app.add_handler(CommandHandler("exporttopics", cmd_exporttopics))
+    bot_app.add_handler(CommandHandler("stats", cmd_stats))
     bot_app.add_handler(CallbackQueryHandler(callback_handler))
     bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_text))
 
@@ -1234,14 +3375,23 @@ async def main():
 
     client = TelegramClient('support_session', API_ID, API_HASH)
     client.add_event_handler(telethon_handler, events.NewMessage())
+    client.add_event_handler(telethon_album_handler, events.Album())
     client.add_event_handler(telethon_edit_handler, events.MessageEdited())
 
     await client.start()
+    Outbox.start()
     logger.info("🚀 Бот запущен. Поддержка множественных каналов назначения активна.")
 
-    async with bot_app:
-        await bot_app.updater.start_polling()
-        await client.run_until_disconnected()
+    try:
+        async with bot_app:
+            await bot_app.updater.start_polling()
+            await client.run_until_disconnected()
+    finally:
+        await Outbox.stop()
+        await StreamRelay.close()
+        TopicManager.flush()
+        DB.stop()
+        DB.close()
 
 if __name__ == "__main__":
     if sys.platform.startswith('win'):